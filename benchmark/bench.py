@@ -0,0 +1,200 @@
+"""
+Offline benchmark of the serialize, embed, load, scan and filter paths of Controlnet Fastload
+
+    python benchmark/bench.py --units 3 --resolution 512 --pictures 2000 --output after.json
+    python benchmark/bench.py --compare before.json after.json
+
+webui and gradio are replaced by the stand-ins of stubs.py, every path runs on synthetic data in a temporary
+folder. Results are JSON: per path the iterations, throughput, mean/p50/p99 latency and the peak Python memory
+(tracemalloc, numpy buffers included) of one extra run.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import stubs
+import synthetic
+
+allPaths = ["serialize", "embed", "load_cold", "load_warm", "extract", "scan_cold", "scan_warm", "filter"]
+
+
+def measure(fn: Callable[[], object], iterations: int, setup: Optional[Callable[[], None]] = None,
+            unitBytes: int = 0) -> dict:
+    """
+    Time fn over iterations runs, setup runs before each of them outside of the timing
+    :param unitBytes: Bytes processed by one run, adds a MB/s figure when given
+    """
+    latencies = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    total = sum(latencies)
+    result = {
+        "iterations": iterations,
+        "seconds": total,
+        "throughput_per_s": iterations / total if total > 0 else None,
+        "mean_ms": 1000 * total / iterations,
+        "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+        "p99_ms": 1000 * float(np.percentile(latencies, 99)),
+        "peak_memory_bytes": peak,
+    }
+    if unitBytes:
+        result["bytes"] = unitBytes
+        result["mb_per_s"] = unitBytes * iterations / total / 1e6 if total > 0 else None
+    return result
+
+
+def run(args: argparse.Namespace) -> dict:
+    opts = stubs.install({"payloadCodec": args.codec, "payloadCompressLevel": args.level})
+    import scripts.fastload as fastload
+    import scripts.fastload_view as fastload_view
+    from scripts.fastload_cache import loadCache, headerCache
+    from scripts.fastload_index import locateIndexFile
+    from scripts.fastload_params import parseControlNet
+    paths = args.paths.split(",") if args.paths else allPaths
+    workdir = tempfile.mkdtemp(prefix="cnfl-bench-", dir=args.workdir)
+    results: Dict[str, dict] = {}
+    indexPath = None
+    try:
+        units = synthetic.makeUnits(args.units, args.resolution, args.seed)
+        picture = os.path.join(workdir, "picture.png")
+        synthetic.makePicture(picture, args.picture_resolution, synthetic.makeParameters(
+            random.Random(args.seed), args.units), args.seed)
+        serialized = fastload.serializeControlNetList(units)
+        if "serialize" in paths:
+            results["serialize"] = measure(lambda: fastload.serializeControlNetList(units), args.iterations,
+                                           unitBytes=len(serialized))
+        if "embed" in paths:
+            target = os.path.join(workdir, "embed.png")
+            results["embed"] = measure(lambda: fastload.addToPicture(target, units, "filepath"), args.iterations,
+                                       setup=lambda: shutil.copyfile(picture, target), unitBytes=len(serialized))
+        loadTarget = os.path.join(workdir, "load.png")
+        shutil.copyfile(picture, loadTarget)
+        fastload.addToPicture(loadTarget, units, "filepath")
+
+        def clearCaches() -> None:
+            loadCache.clear()
+            headerCache.clear()
+        if "load_cold" in paths:
+            results["load_cold"] = measure(lambda: fastload.loadFromFile(loadTarget), args.iterations,
+                                           setup=clearCaches, unitBytes=len(serialized))
+        if "load_warm" in paths:
+            fastload.loadFromFile(loadTarget)
+            results["load_warm"] = measure(lambda: fastload.loadFromFile(loadTarget), args.iterations)
+        if "extract" in paths:
+            rand = random.Random(args.seed)
+            texts = [synthetic.makeParameters(rand, args.units) for _ in range(1000)]
+            results["extract"] = measure(lambda: [[unit.pairs() for unit in parseControlNet(text)]
+                                                  for text in texts], args.iterations)
+            results["extract"]["items_per_iteration"] = len(texts)
+        if {"scan_cold", "scan_warm", "filter"} & set(paths):
+            folder = os.path.join(workdir, "outputs")
+            synthetic.makeFolder(folder, args.pictures, unitCount=args.units, seed=args.seed)
+            indexPath = locateIndexFile(os.path.realpath(folder), bool(opts.data.get("isFilterIndexInViewFolder")))[0]
+
+            def dropIndex() -> None:
+                # A fresh FilterIndex object as well, the registry keeps one per database file
+                sys.modules["scripts.fastload_index"]._indexes.clear()
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(indexPath + suffix):
+                        os.remove(indexPath + suffix)
+            if "scan_cold" in paths:
+                results["scan_cold"] = measure(lambda: fastload_view.loadPicture(folder), args.iterations,
+                                               setup=dropIndex)
+                results["scan_cold"]["items_per_iteration"] = args.pictures
+            engine = fastload_view.loadPicture(folder)
+            if "scan_warm" in paths:
+                results["scan_warm"] = measure(lambda: fastload_view.loadPicture(folder), args.iterations)
+                results["scan_warm"]["items_per_iteration"] = args.pictures
+            if "filter" in paths:
+                key = "model"
+                value = engine.counts(key)[0][0]
+                filters = [f"{key} - {value}", "weight - 0.5..1", "NOT control mode - Balanced"]
+
+                def query() -> List[str]:
+                    return engine.page(engine.query(filters), 0, int(opts.data.get("filterPageSize", 36)))
+                results["filter"] = measure(query, args.iterations)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        # The index may live in the cache folder of the extension rather than in workdir
+        for suffix in ("", "-wal", "-shm", "-journal") if indexPath else ():
+            if os.path.exists(indexPath + suffix):
+                os.remove(indexPath + suffix)
+    return {
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "parameters": {"units": args.units, "resolution": args.resolution, "pictures": args.pictures,
+                       "picture_resolution": args.picture_resolution, "iterations": args.iterations,
+                       "seed": args.seed, "codec": args.codec, "level": args.level},
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict) -> dict:
+    """
+    Ratios after/before of the latencies and the peak memory, below 1 is an improvement
+    """
+    ratios = {}
+    for path, result in after["results"].items():
+        old = before["results"].get(path)
+        if old is None:
+            continue
+        ratios[path] = {key: result[key] / old[key] if old[key] else None
+                        for key in ("mean_ms", "p50_ms", "p99_ms", "peak_memory_bytes")}
+    return {"before": before["parameters"], "after": after["parameters"], "ratios": ratios}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Controlnet Fastload offline benchmark")
+    parser.add_argument("--units", type=int, default=2, help="ControlNet units per list and per picture")
+    parser.add_argument("--resolution", type=int, default=512, help="Control image resolution")
+    parser.add_argument("--pictures", type=int, default=500, help="Pictures in the synthetic output folder")
+    parser.add_argument("--picture-resolution", type=int, default=512, help="Resolution of the embed/load picture")
+    parser.add_argument("--iterations", type=int, default=10, help="Timed runs per path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--codec", default="auto", help="Payload codec of the serialize/embed/load paths")
+    parser.add_argument("--level", type=int, default=1, help="Payload compression level")
+    parser.add_argument("--paths", default="", help=f"Comma-separated subset of {','.join(allPaths)}")
+    parser.add_argument("--workdir", default=None, help="Folder for the synthetic data, a temp folder by default")
+    parser.add_argument("--output", default=None, help="Write the JSON here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            report = compare(json.load(before), json.load(after))
+    else:
+        # The scripts print to stdout, keep it clean for the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Stand-ins for the webui modules and gradio, enough to import the extension scripts outside of webui
+Only the benchmark uses them, they are installed into sys.modules before the scripts are imported
+"""
+import os
+import sys
+import types
+
+
+class Component:
+    """
+    Any gradio component or layout block: accepts every argument, works as a context manager, ignores events
+    """
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: None
+
+
+class Options:
+    """
+    shared.opts: settings live in data, attribute access reads them too
+    """
+    def __init__(self, data: dict):
+        self.data = data
+
+    def __getattr__(self, name: str):
+        try:
+            return self.__dict__["data"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def add_option(self, key: str, info) -> None:
+        self.data.setdefault(key, info.default)
+
+
+class OptionInfo:
+    def __init__(self, default=None, label="", component=None, component_args=None, section=None, **kwargs):
+        self.default = default
+
+    def needs_restart(self) -> "OptionInfo":
+        return self
+
+
+class ImageSaveParams:
+    def __init__(self, image=None, p=None, filename: str = "", pnginfo=None):
+        self.image = image
+        self.p = p
+        self.filename = filename
+        self.pnginfo = pnginfo or {}
+
+
+benchmarkOptions = {
+    "saveControlnet": "Embed photo",
+    "overwritePriority": "ControlNet Plugin First",
+    "isFilterIndexInViewFolder": False,
+    "isEnabledThumbnail": False,
+    "isEnabledBackgroundWriter": False,
+    "isEnabledBlobStore": False,
+    "filterWatchInterval": 0,
+}
+
+
+def makeModule(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install(options: dict = None) -> Options:
+    """
+    Put the stand-ins into sys.modules and the repository root onto sys.path
+    :return: The stand-in shared.opts, benchmarks adjust its data
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    opts = Options(dict(benchmarkOptions, **(options or {})))
+    noop = lambda *args, **kwargs: None
+
+    gradio = makeModule("gradio", Error=type("Error", (Exception,), {}), update=lambda **kwargs: kwargs,
+                        SelectData=Component)
+    gradio.__getattr__ = lambda name: type(name, (Component,), {})
+    components = makeModule("gradio.components")
+    components.__getattr__ = lambda name: type(name, (Component,), {})
+    gradio.components = components
+
+    modules = makeModule("modules")
+    modules.__path__ = []
+    callbacks = makeModule("modules.script_callbacks", ImageSaveParams=ImageSaveParams)
+    callbacks.__getattr__ = lambda name: noop
+    modules.script_callbacks = callbacks
+    modules.shared = makeModule("modules.shared", opts=opts, OptionInfo=OptionInfo,
+                                cmd_opts=types.SimpleNamespace(share=False, ngrok=None, listen=False,
+                                                               server_name=None))
+    modules.scripts = makeModule("modules.scripts", Script=object, AlwaysVisible=object(),
+                                 basedir=lambda: os.getcwd())
+    modules.images = makeModule("modules.images", read_info_from_image=lambda image: ("", {}))
+    modules.processing = makeModule("modules.processing", process_images=noop, Processed=object)
+    modules.generation_parameters_copypaste = makeModule(
+        "modules.generation_parameters_copypaste", register_paste_params_button=noop, ParamBinding=Component)
+    return opts
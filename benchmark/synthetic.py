@@ -0,0 +1,105 @@
+"""
+Synthetic ControlNet unit lists and output folders for the benchmark
+"""
+import os
+import random
+import numpy as np
+from PIL import Image, PngImagePlugin
+from typing import List
+
+preprocessors = ["canny", "depth_midas", "openpose_full", "lineart_realistic", "softedge_pidinet", "none"]
+models = ["control_v11p_sd15_canny [d14c016b]", "control_v11f1p_sd15_depth [cfd03158]",
+          "control_v11p_sd15_openpose [cab727d4]", "control_v11p_sd15_lineart [43d4be0d]",
+          "control_v11p_sd15_softedge [a8575a2a]"]
+resizeModes = ["Crop and Resize", "Just Resize", "Resize and Fill"]
+controlModes = ["Balanced", "My prompt is more important", "ControlNet is more important"]
+
+
+def makeControlImage(rng: np.random.Generator, resolution: int) -> np.ndarray:
+    """
+    Line drawing on black like a canny or lineart map, it compresses like a real control image, noise would not
+    """
+    image = np.zeros((resolution, resolution, 3), dtype=np.uint8)
+    for _ in range(max(4, resolution // 16)):
+        if rng.random() < 0.5:
+            row = rng.integers(0, resolution)
+            start, end = sorted(rng.integers(0, resolution, 2))
+            image[row, start:end] = 255
+        else:
+            column = rng.integers(0, resolution)
+            start, end = sorted(rng.integers(0, resolution, 2))
+            image[start:end, column] = 255
+    return image
+
+
+def makeUnits(unitCount: int, resolution: int, seed: int = 0) -> List[dict]:
+    """
+    ControlNetList of unitCount enabled units, each with an RGB control image of resolution x resolution
+    """
+    rng = np.random.default_rng(seed)
+    units = []
+    for index in range(unitCount):
+        units.append({
+            "enabled": True,
+            "module": preprocessors[index % len(preprocessors)],
+            "model": models[index % len(models)],
+            "weight": round(float(rng.uniform(0.3, 1.2)), 2),
+            "image": {"image": makeControlImage(rng, resolution),
+                      "mask": np.zeros((resolution, resolution, 4), dtype=np.uint8)},
+            "resize_mode": resizeModes[index % len(resizeModes)],
+            "low_vram": False,
+            "processor_res": 512,
+            "threshold_a": 100.0,
+            "threshold_b": 200.0,
+            "guidance_start": 0.0,
+            "guidance_end": 1.0,
+            "pixel_perfect": bool(index % 2),
+            "control_mode": controlModes[index % len(controlModes)],
+        })
+    return units
+
+
+def makeParameters(rand: random.Random, unitCount: int) -> str:
+    """
+    Infotext as webui writes it, with the ControlNet entries the Filter tab parses
+    """
+    lines = ["a photo of a cat sitting on a wooden table, masterpiece, best quality",
+             "Negative prompt: lowres, bad anatomy, blurry",
+             ]
+    params = [f"Steps: {rand.choice([20, 25, 30])}", "Sampler: DPM++ 2M Karras", f"CFG scale: {rand.choice([5, 7, 9])}",
+              f"Seed: {rand.randrange(2 ** 32)}", "Size: 512x768", "Model hash: 6ce0161689", "Model: v1-5-pruned-emaonly"]
+    for index in range(unitCount):
+        start = rand.choice([0, 0, 0.1, 0.2])
+        params.append(f'ControlNet {index}: "preprocessor: {rand.choice(preprocessors)}, '
+                      f'model: {rand.choice(models)}, weight: {rand.choice([0.5, 0.75, 1, 1.2])}, '
+                      f'starting/ending: ({start}, {rand.choice([0.8, 1])}), resize mode: {rand.choice(resizeModes)}, '
+                      f'pixel perfect: {rand.choice([True, False])}, control mode: {rand.choice(controlModes)}, '
+                      f'preprocessor params: (512, 100, 200)"')
+    params.append("Version: v1.6.0")
+    return "\n".join(lines) + "\n" + ", ".join(params)
+
+
+def makePicture(path: str, resolution: int, parameters: str, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, resolution, dtype=np.uint8)
+    image = np.stack([np.tile(gradient, (resolution, 1)), np.tile(gradient[:, None], (1, resolution)),
+                      np.full((resolution, resolution), rng.integers(0, 256), dtype=np.uint8)], axis=2)
+    info = PngImagePlugin.PngInfo()
+    info.add_text("parameters", parameters)
+    Image.fromarray(image).save(path, pnginfo=info)
+
+
+def makeFolder(folder: str, count: int, resolution: int = 64, unitCount: int = 2, subFolders: int = 4,
+               seed: int = 0) -> List[str]:
+    """
+    Output folder of count PNG pictures spread over date-like subfolders, each with realistic parameters
+    """
+    rand = random.Random(seed)
+    paths = []
+    for index in range(count):
+        subFolder = os.path.join(folder, f"2024-01-{index % subFolders + 1:02d}")
+        os.makedirs(subFolder, exist_ok=True)
+        path = os.path.join(subFolder, f"{index:05d}-{rand.randrange(2 ** 32)}.png")
+        makePicture(path, resolution, makeParameters(rand, rand.randint(0, unitCount)), seed + index)
+        paths.append(path)
+    return paths
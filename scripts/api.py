@@ -1,20 +1,290 @@
-import base64
+import os
 import io
+import json
+import uuid
+import asyncio
+import threading
+import base64
+import shutil
+import tempfile
 from PIL import Image
 import gradio as gr
 import numpy as np
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, File, Form, Query, Request, UploadFile
 from fastapi.exceptions import HTTPException
-from scripts.fastload import viewSaveDataExecute, addToPicture
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from scripts.fastload import loadFromFile, serializeControlNetList, getBlobStore
+from scripts.fastload_payload import buildPayload, embedPayload, embedPayloadInBytes, embedPayloadChunks, writeSidecar
+from scripts.fastload_container import LazyImage, arrayFormat
 import scripts.api_package as api_package
+from scripts.fastload_cache import loadCache, headerCache
+from scripts.fastload_writer import backgroundWriter
+from scripts.fastload_log import metrics
+from scripts.fastload_pnginfo import pictureExtensions
 import modules.script_callbacks as script_callbacks
+from modules.shared import opts
+
+outputDirOptions = ["outdir_samples", "outdir_txt2img_samples", "outdir_img2img_samples",
+                    "outdir_grids", "outdir_txt2img_grids", "outdir_img2img_grids", "outdir_save"]
+binaryChunkSize = 1 << 20
+imageEncodings = ["base64", "nparray", "npy", "raw"]
+batchPool = None
+batchPoolLock = threading.Lock()
+
+
+def serializeDrawId(ControlNetID: int) -> bytes:
+    """
+    Look up and serialize the ControlNet data of a generation, off the event loop:
+    an entry spilled to disk is read and decoded by the lookup
+    :raise KeyError: The ID is unknown or expired
+    """
+    return serializeControlNetList(api_package.api_instance.drawId[ControlNetID], False)
+
+
+async def fetchBinary(picture: bytes, ControlNetID: int, returnFileType: str) -> StreamingResponse:
+    """
+    Serialize the ControlNet data of a generation once and stream the requested files back
+    One file is sent as application/octet-stream, "Both" as multipart/mixed with a photo and a cni part.
+    Without a picture only the .cni file is returned.
+    """
+    try:
+        serialized_data = await run_in_threadpool(serializeDrawId, ControlNetID)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=422, detail="Controlnet not found: " + str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=422, detail="An error occurred: " + str(e)
+        )
+    parts = []
+    if picture and (returnFileType == "Embed photo" or returnFileType == "Both"):
+        parts.append(("photo", embedPayloadChunks(picture, serialized_data)))
+    if not picture or returnFileType == "Extra .cni file" or returnFileType == "Both":
+        parts.append(("cni", [buildPayload(serialized_data, 0)]))
+    if len(parts) == 1:
+        name, chunks = parts[0]
+        return StreamingResponse(iterChunks(chunks), media_type="application/octet-stream",
+                                 headers={"Content-Disposition": f'attachment; filename="controlnet.{name}"'})
+    boundary = uuid.uuid4().hex
+    return StreamingResponse(iterMultipart(parts, boundary), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def iterChunks(chunks: list) -> Iterator[bytes]:
+    for chunk in chunks:
+        view = memoryview(chunk)
+        for start in range(0, len(view), binaryChunkSize):
+            yield bytes(view[start:start + binaryChunkSize])
+
+
+def iterMultipart(parts: list, boundary: str) -> Iterator[bytes]:
+    for name, chunks in parts:
+        yield (f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+               f'Content-Disposition: attachment; name="{name}"; filename="controlnet.{name}"\r\n\r\n').encode()
+        yield from iterChunks(chunks)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def viewFile(filepath: str, except_type: str, withImages: bool, units: List[int], pngCompressLevel: int) -> dict:
+    """
+    ControlNet data of a file for the view endpoints
+    Control images of units that are not requested, or of every unit without withImages, are never decoded.
+    pic_meta tells for every entry of pic_list the unit, the key of the image in the unit, its encoding,
+    shape and dtype; "base64" gives PNG (.npy for arrays PNG cannot hold), "npy" a .npy file,
+    "raw" the bare array bytes, all base64-encoded, and "nparray" nested lists
+    """
+    if except_type not in imageEncodings:
+        raise HTTPException(
+            status_code=422, detail=f"except_type should be one of {', '.join(imageEncodings)}")
+    datalist = loadFromFile(filepath, enableWarn=False, decodeImages=False)
+    if datalist and isinstance(datalist[0], dict) and "Error" in datalist[0]:
+        raise HTTPException(
+            status_code=422, detail="An error occurred: " + str(datalist[0]["Error"])
+        )
+    return viewUnits(datalist, except_type, withImages, units, pngCompressLevel)
+
+
+def viewUnits(datalist: list, except_type: str, withImages: bool, units: List[int], pngCompressLevel: int) -> dict:
+    """
+    Same as viewFile for a ControlNetList already in memory
+    """
+    if except_type not in imageEncodings:
+        raise HTTPException(
+            status_code=422, detail=f"except_type should be one of {', '.join(imageEncodings)}")
+    try:
+        picList, picMeta, infoList = [], [], []
+        for index, unit in enumerate(datalist):
+            if units and index not in units:
+                continue
+            info = dict(unit if isinstance(unit, dict) else vars(unit))
+            for key, value in list(info.items()):
+                images = list(iterImages(value, key))
+                if not images:
+                    continue
+                info.pop(key)
+                for imageKey, image in images if withImages else []:
+                    array = image.load() if isinstance(image, LazyImage) else np.asarray(image)
+                    data, encoding = encodeViewImage(array, except_type, pngCompressLevel)
+                    picList.append(data)
+                    picMeta.append({"unit": index, "key": imageKey, "encoding": encoding,
+                                    "shape": list(array.shape), "dtype": array.dtype.str})
+            infoList.append(info)
+    except Exception as e:
+        raise HTTPException(
+            status_code=422, detail="An error occurred: " + str(e)
+        )
+    return {
+        "pic_list": picList,
+        "pic_meta": picMeta,
+        "info_list": infoList
+    }
+
+
+def iterImages(value: Any, key: str) -> Iterator[Tuple[str, Any]]:
+    if isinstance(value, (np.ndarray, LazyImage)):
+        yield key, value
+    elif isinstance(value, dict):
+        for subKey, subValue in value.items():
+            yield from iterImages(subValue, f"{key}.{subKey}")
+
+
+def encodeViewImage(array: np.ndarray, except_type: str, pngCompressLevel: int) -> Tuple[Any, str]:
+    if except_type == "base64" and arrayFormat(array) == "png":
+        io_ = io.BytesIO()
+        Image.fromarray(array).save(io_, format="PNG", compress_level=pngCompressLevel)
+        return base64.b64encode(io_.getvalue()), "png"
+    if except_type == "nparray":
+        return array.tolist(), "nparray"
+    if except_type == "raw":
+        return base64.b64encode(np.ascontiguousarray(array).tobytes()), "raw"
+    io_ = io.BytesIO()
+    np.lib.format.write_array(io_, array, allow_pickle=False)
+    return base64.b64encode(io_.getvalue()), "npy"
+
+
+def isWritableOutput(filepath: str) -> bool:
+    """
+    Whether an API caller may have ControlNet data written into filepath: only pictures inside the webui
+    output folders qualify, anything else the webui process can write stays out of reach
+    """
+    if os.path.splitext(filepath)[1].lower() not in pictureExtensions:
+        return False
+    realpath = os.path.realpath(filepath)
+    for key in outputDirOptions:
+        folder = opts.data.get(key)
+        if not folder:
+            continue
+        folder = os.path.realpath(folder)
+        try:
+            if os.path.commonpath([realpath, folder]) == folder:
+                return True
+        except ValueError:
+            continue
+    return False
+
+
+def getBatchPool() -> ThreadPoolExecutor:
+    """
+    Pool shared by all batch requests, so concurrent batches together stay within apiBatchWorkers threads
+    """
+    global batchPool
+    workers = max(1, int(opts.data.get("apiBatchWorkers", 4)))
+    with batchPoolLock:
+        if batchPool is None or batchPool._max_workers != workers:
+            if batchPool is not None:
+                batchPool.shutdown(wait=False)
+            batchPool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cnfl-batch")
+        return batchPool
+
+
+def runBatchItem(work: Callable[[Any], dict], index: int, item: Any) -> bytes:
+    try:
+        line = {"index": index, **work(item)}
+    except HTTPException as e:
+        line = {"index": index, "error": e.detail}
+    except KeyError as e:
+        line = {"index": index, "error": "Controlnet not found: " + str(e)}
+    except Exception as e:
+        line = {"index": index, "error": "An error occurred: " + str(e)}
+    return (json.dumps(jsonable_encoder(line)) + "\n").encode()
+
+
+async def iterBatch(items: list, work: Callable[[Any], dict]) -> AsyncIterator[bytes]:
+    """
+    Run work over items on the batch pool and yield one NDJSON line per item as soon as it is done,
+    lines carry the index of their item since they arrive in completion order
+    At most twice as many items as there are workers are in flight, a slow client holds back the batch
+    """
+    pool = getBatchPool()
+    loop = asyncio.get_running_loop()
+    window = pool._max_workers * 2
+    pending = set()
+    for index, item in enumerate(items):
+        pending.add(loop.run_in_executor(pool, runBatchItem, work, index, item))
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def registerGauges() -> None:
+    for name, stats in (("load_cache", loadCache.stats), ("header_cache", headerCache.stats),
+                        ("drawid", api_package.api_instance.drawId.stats)):
+        for key in ("entries", "size", "hits", "misses", "evictions"):
+            metrics.gauge(f"{name}_{key}", lambda stats=stats, key=key: stats()[key])
+    for key in ("depth", "pending", "written", "failed"):
+        metrics.gauge(f"writer_{key}", lambda key=key: backgroundWriter.stats()[key])
 
 
 def controlnet_api(_: gr.Blocks, app: FastAPI):
+    registerGauges()
     @app.get("/controlnetFastload/version")
     async def version():
         return {"version": 1.1}
 
+    @app.get("/controlnetFastload/metrics")
+    async def metrics_(
+            format_: str = Query("json", alias="format")
+    ):
+        # "prometheus" for the text exposition format, anything else gives JSON
+        if format_ == "prometheus":
+            return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+        return metrics.snapshot()
+
+    @app.get("/controlnetFastload/cache")
+    async def cache():
+        return {
+            "load": loadCache.stats(),
+            "header": headerCache.stats()
+        }
+
+    @app.get("/controlnetFastload/drawId")
+    async def draw_id():
+        return api_package.api_instance.drawId.stats()
+
+    @app.get("/controlnetFastload/writer")
+    async def writer():
+        return backgroundWriter.stats()
+
+    @app.post("/controlnetFastload/writer/flush")
+    def writer_flush(
+            timeout: float = Body(60, title='timeout')
+    ):
+        # Clients reading the saved pictures right after a generation wait here until their payloads are on disk
+        return {
+            "flushed": backgroundWriter.flush(timeout),
+            "writer": backgroundWriter.stats()
+        }
+
     @app.post("/controlnetFastload/fetch")
     async def fetch(
             returnFileType: str = Body("Extra .cni file", title='returnType'),
@@ -23,19 +293,18 @@ def controlnet_api(_: gr.Blocks, app: FastAPI):
     ):
         try:
             result_dict = {}
-            controlnetList_ = api_package.api_instance.drawId[ControlNetID]
+            # Serialized once, "Both" returns the same embedded picture under both keys
+            serialized_data = await run_in_threadpool(serializeDrawId, ControlNetID)
+            embedded = base64.b64encode(embedPayloadInBytes(base64.b64decode(extraPicBase64), serialized_data))
             # 先考虑extraPicBase64=="", 此时一定返回.cni
             if extraPicBase64 == "":
-                result_dict['.cni'] = addToPicture("", controlnetList_, "base64")
+                result_dict['.cni'] = embedded
             # 在考虑extraPicBase64!="", 此时要看returnFileType
             else:
-                if returnFileType == "Embed photo":
-                    result_dict['photo'] = addToPicture(extraPicBase64, controlnetList_, "base64")
-                if returnFileType == "Extra .cni file":
-                    result_dict['.cni'] = addToPicture(extraPicBase64, controlnetList_, "base64")
-                if returnFileType == "Both":
-                    result_dict['photo'] = addToPicture(extraPicBase64, controlnetList_, "base64")
-                    result_dict['.cni'] = addToPicture(extraPicBase64, controlnetList_, "base64")
+                if returnFileType == "Embed photo" or returnFileType == "Both":
+                    result_dict['photo'] = embedded
+                if returnFileType == "Extra .cni file" or returnFileType == "Both":
+                    result_dict['.cni'] = embedded
         except KeyError as e:
             raise HTTPException(
                 status_code=422, detail="Controlnet not found: " + str(e)
@@ -46,35 +315,132 @@ def controlnet_api(_: gr.Blocks, app: FastAPI):
             )
         return result_dict
 
+    @app.post("/controlnetFastload/fetch/raw")
+    async def fetch_raw(
+            request: Request,
+            ControlNetID: int = Query(title='ControlNetID'),
+            returnFileType: str = Query("Embed photo", title='returnType')
+    ):
+        # The request body is the picture itself, no base64
+        return await fetchBinary(await request.body(), ControlNetID, returnFileType)
+
+    @app.post("/controlnetFastload/fetch/upload")
+    async def fetch_upload(
+            file: Optional[UploadFile] = File(None),
+            ControlNetID: int = Form(title='ControlNetID'),
+            returnFileType: str = Form("Embed photo", title='returnType')
+    ):
+        return await fetchBinary(await file.read() if file is not None else b"", ControlNetID, returnFileType)
+
     @app.post("/controlnetFastload/view")
-    async def view(
+    def view(
             filepath: str = Body("", title='filepath'),
-            except_type: str = Body("base64", title='except_type')
+            except_type: str = Body("base64", title='except_type'),
+            withImages: bool = Body(True, title='withImages'),
+            units: List[int] = Body([], title='units'),
+            pngCompressLevel: int = Body(1, title='pngCompressLevel')
     ):
-        base64_pic_list = []
         if filepath == "":
             raise HTTPException(
                 status_code=422, detail="No file uploaded")
+        return viewFile(filepath, except_type, withImages, units, pngCompressLevel)
+
+    @app.post("/controlnetFastload/view/upload")
+    def view_upload(
+            file: UploadFile = File(title='file'),
+            except_type: str = Form("base64", title='except_type'),
+            withImages: bool = Form(True, title='withImages'),
+            units: List[int] = Form([], title='units'),
+            pngCompressLevel: int = Form(1, title='pngCompressLevel')
+    ):
+        suffix = os.path.splitext(file.filename or "")[1]
+        fd, tmpPath = tempfile.mkstemp(prefix="cnfl-view-", suffix=suffix)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(file.file, out)
+            return viewFile(tmpPath, except_type, withImages, units, pngCompressLevel)
+        finally:
+            os.remove(tmpPath)
+
+    @app.post("/controlnetFastload/batch/extract")
+    async def batch_extract(
+            filepaths: List[str] = Body([], title='filepaths'),
+            ControlNetIDs: List[int] = Body([], title='ControlNetIDs'),
+            except_type: str = Body("base64", title='except_type'),
+            withImages: bool = Body(True, title='withImages'),
+            units: List[int] = Body([], title='units'),
+            pngCompressLevel: int = Body(1, title='pngCompressLevel')
+    ):
+        # Items are the files followed by the IDs, the index of a line refers to this order
+        def work(item: Any) -> dict:
+            if isinstance(item, str):
+                return {"filepath": item,
+                        "result": viewFile(item, except_type, withImages, units, pngCompressLevel)}
+            datalist = api_package.api_instance.drawId[item]
+            return {"ControlNetID": item,
+                    "result": viewUnits(datalist, except_type, withImages, units, pngCompressLevel)}
+        return StreamingResponse(iterBatch(list(filepaths) + list(ControlNetIDs), work),
+                                 media_type="application/x-ndjson")
+
+    @app.post("/controlnetFastload/batch/embed")
+    async def batch_embed(
+            items: List[dict] = Body(title='items'),
+            saveType: str = Body("Embed photo", title='saveType')
+    ):
+        """
+        Every item is {"ControlNetID": int, "filepath": str, "saveType": optional str}, the ControlNet data
+        of the ID is embedded into the picture and/or written next to it as a .cni file.
+        Only pictures inside the webui output folders are accepted.
+        The data of an ID is serialized once for the whole batch.
+        """
+        bodies, locks = {}, {}
+        guard = threading.Lock()
+
+        def serialized(drawId: int) -> bytes:
+            with guard:
+                lock = locks.setdefault(drawId, threading.Lock())
+            with lock:
+                if drawId not in bodies:
+                    bodies[drawId] = serializeControlNetList(api_package.api_instance.drawId[drawId])
+                return bodies[drawId]
+
+        def work(item: dict) -> dict:
+            drawId, filepath = int(item["ControlNetID"]), str(item["filepath"])
+            saveType_ = item.get("saveType", saveType)
+            if not isWritableOutput(filepath):
+                raise ValueError(f"File {filepath} is not a picture inside the webui output folders.")
+            if not os.path.isfile(filepath):
+                raise ValueError(f"File {filepath} does not exist.")
+            serialized_data = serialized(drawId)
+            written = []
+            if saveType_ == "Embed photo" or saveType_ == "Both":
+                embedPayload(filepath, serialized_data)
+                written.append(filepath)
+            if saveType_ == "Extra .cni file" or saveType_ == "Both":
+                cniPath = os.path.splitext(filepath)[0] + ".cni"
+                writeSidecar(cniPath, serialized_data)
+                written.append(cniPath)
+            return {"ControlNetID": drawId, "filepath": filepath, "written": written}
+        return StreamingResponse(iterBatch(items, work), media_type="application/x-ndjson")
+
+    @app.post("/controlnetFastload/blobs/gc")
+    def blobs_gc(
+            roots: List[str] = Body([], title='roots'),
+            graceSeconds: float = Body(3600, title='graceSeconds')
+    ):
+        # Every folder that may hold pictures or .cni files referencing the blob store has to be listed,
+        # blobs only referenced from elsewhere would be removed
+        roots_ = roots or [opts.data.get(key) for key in outputDirOptions if opts.data.get(key)]
         try:
-            pic_list, info_dict = viewSaveDataExecute(filepath)
-            for pic in pic_list:
-                if except_type == "base64":
-                    pic_ = Image.fromarray(pic)
-                    io_ = io.BytesIO()
-                    pic_.save(io_, format="PNG")
-                    base64_pic_list.append(base64.b64encode(io_.getvalue()))
-                elif except_type == "nparray":
-                    base64_pic_list.append(np.array2string(pic))
-                else:
-                    raise HTTPException(
-                        status_code=422, detail="except_type should be base64 or nparray")
+            removed, freed = getBlobStore().collectGarbage(roots_, graceSeconds)
         except Exception as e:
             raise HTTPException(
                 status_code=422, detail="An error occurred: " + str(e)
             )
         return {
-            "pic_list": base64_pic_list,
-            "info_list": info_dict
+            "roots": roots_,
+            "removed": removed,
+            "freed": freed
         }
 
 
@@ -1,14 +1,154 @@
-from datetime import datetime
+import os
+import time
+import itertools
+import threading
+from typing import Optional
+from scripts.fastload_cache import LRUCache
+from scripts.fastload_payload import readFooter, writeSidecar, PayloadError, defaultMaxPayloadSize
+from scripts.fastload_container import serializeUnits, openContainer
+from scripts.fastload_writer import backgroundWriter
+from scripts.fastload_log import logger
+
+extensionDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+defaultSpillDir = os.path.join(extensionDir, "cache", "drawid")
+
+
+class DrawStore:
+    """
+    ControlNetList of every API generation, looked up by the ControlNetID written into its infotext
+    IDs are unique for the life of the process and start from the clock, so an ID from before a restart
+    never names another generation. Entries expire after ttl seconds, and the least recently used ones
+    beyond maxBytes are spilled to disk as .cni files (or dropped when spilling is off).
+    """
+    def __init__(self, ttl: float = 3600, maxBytes: int = 1024 * 1024 * 1024,
+                 spillDir: Optional[str] = defaultSpillDir):
+        self.ttl = ttl
+        self.spillDir = spillDir
+        self.maxPayloadSize = defaultMaxPayloadSize
+        self._ids = itertools.count(time.time_ns() // 1000)
+        self._entries = LRUCache(maxBytes, onEvict=self._spill)
+        self._spilling = {}
+        self._pendingSpills = []
+        self._lock = threading.Lock()
+
+    def configure(self, ttl: float, maxBytes: int, spill: bool, maxPayloadSize: int = defaultMaxPayloadSize) -> None:
+        self.ttl = ttl
+        self.spillDir = defaultSpillDir if spill else None
+        self.maxPayloadSize = maxPayloadSize
+        self._entries.resize(maxBytes)
+        self._submitSpills()
+
+    def newId(self) -> int:
+        return next(self._ids)
+
+    def put(self, drawId: int, datalist: list, size: int = 1) -> None:
+        self._entries.put(drawId, (datalist, time.time()), size)
+        self._submitSpills()
+
+    def get(self, drawId: int) -> list:
+        """
+        :raise KeyError: The ID is unknown or expired
+        """
+        entry = self._entries.get(drawId)
+        if entry is not None:
+            datalist, created = entry
+            if time.time() - created <= self.ttl:
+                return datalist
+            self._entries.pop(drawId)
+            raise KeyError(drawId)
+        with self._lock:
+            if drawId in self._spilling:
+                return self._spilling[drawId]
+        return self._loadSpilled(drawId)
+
+    def __getitem__(self, drawId: int) -> list:
+        return self.get(drawId)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {**self._entries.stats(), "spilling": len(self._spilling), "ttl": self.ttl,
+                "spillDir": self.spillDir}
+
+    def spillPath(self, drawId: int) -> str:
+        return os.path.join(self.spillDir or defaultSpillDir, f"{int(drawId)}.cni")
+
+    def _spill(self, drawId: int, entry: tuple) -> None:
+        """
+        Called under the lock of the LRU cache: the entry stays readable from _spilling,
+        its write is only queued by _submitSpills once the cache lock is released
+        """
+        datalist, created = entry
+        if self.spillDir is None or not datalist or time.time() - created > self.ttl:
+            return
+        with self._lock:
+            self._spilling[drawId] = datalist
+            self._pendingSpills.append((drawId, datalist, created))
+
+    def _submitSpills(self) -> None:
+        """
+        Hand evicted entries to the background writer, which blocks while its queue is full
+        """
+        with self._lock:
+            pending, self._pendingSpills = self._pendingSpills, []
+        for drawId, datalist, created in pending:
+            self._submitSpill(drawId, datalist, created)
+
+    def _submitSpill(self, drawId: int, datalist: list, created: float) -> None:
+        path = self.spillPath(drawId)
+
+        def write() -> None:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writeSidecar(path, serializeUnits(datalist))
+                os.utime(path, (created, created))
+            finally:
+                with self._lock:
+                    self._spilling.pop(drawId, None)
+            self.sweep()
+        backgroundWriter.submit(path, write)
+
+    def _loadSpilled(self, drawId: int) -> list:
+        path = self.spillPath(drawId)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise KeyError(drawId)
+            with open(path, 'rb') as fp:
+                footer = readFooter(fp)
+            if footer is None:
+                raise KeyError(drawId)
+            _, offset, length = footer
+            container = openContainer(path, offset, length, self.maxPayloadSize)
+            if container is None:
+                raise KeyError(drawId)
+            return container.units()
+        except (OSError, PayloadError):
+            raise KeyError(drawId)
+
+    def sweep(self) -> None:
+        """
+        Remove spilled entries older than the TTL
+        """
+        if self.spillDir is None or not os.path.isdir(self.spillDir):
+            return
+        deadline = time.time() - self.ttl
+        for entry in os.scandir(self.spillDir):
+            try:
+                if entry.name.endswith(".cni") and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError:
+                continue
 
 
 class ControlNetFastloadAPI:
     def __init__(self):
         self.enabled = False
-        self.drawId = {}
+        self.drawId = DrawStore()
 
     def info(self):
-        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]} - ControlNetFastload - \033[92mINFO\033[0m - '
-              f'API is {self.enabled}, have {len(self.drawId)} drawId(s)')
+        logger.info(f'API is {self.enabled}, have {len(self.drawId)} drawId(s)')
 
 
 api_instance = ControlNetFastloadAPI()
@@ -1,14 +1,16 @@
 import os
 import re
-import gzip
+import copy
+import zlib
 import pickle
 import base64
 import importlib
+import threading
+from enum import Enum
 import gradio as gr
 import numpy as np
 from PIL import Image
 from typing import Optional, List
-from datetime import datetime
 from gradio import Checkbox, Dropdown, File, Textbox, Button, Gallery, JSON
 import modules.scripts as scripts
 from modules import script_callbacks
@@ -17,18 +19,40 @@ from modules.shared import opts, cmd_opts
 from modules.images import read_info_from_image
 from modules.processing import process_images, Processed
 import modules.generation_parameters_copypaste as parameters_copypaste
+from scripts.fastload_payload import start_marker, end_marker, locatePayload, iterBody, decompressBody, \
+    embedPayload, embedPayloadInBytes, writeSidecar, PayloadError, PayloadTooLarge
+from scripts.fastload_container import serializeUnits, openContainer, isContainer, containerMagic
+from scripts.fastload_cache import loadCache, headerCache, fileKey
+from scripts.fastload_blob import BlobStore, defaultBlobDir
+from scripts.fastload_writer import backgroundWriter
+from scripts.fastload_log import logger, metrics, span
 
-save_flag = False
-controlNetList = []
-save_filetype = ""
 overwrite_flag = ""
-start_marker = b'###START_OF_CONTROLNET_FASTLOAD###'
-end_marker = b'###END_OF_CONTROLNET_FASTLOAD###'
-current_timestamp = lambda: datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]
-print_err = lambda msg: print(f'{current_timestamp()} - ControlNetFastload - \033[91mERROR\033[0m - {msg}')
-print_warn = lambda msg: print(f'{current_timestamp()} - ControlNetFastload - \033[93mWARNING\033[0m - {msg}')
-print_info = lambda msg: print(f'{current_timestamp()} - ControlNetFastload - \033[92mINFO\033[0m - {msg}')
-print_debug = lambda msg: print(f'{current_timestamp()} - PDebug - {msg}')
+print_err = logger.error
+print_warn = logger.warning
+print_info = logger.info
+print_debug = logger.debug
+
+
+class SaveContext:
+    """
+    What a job saves with its pictures, kept on its processing object as p.controlnetFastloadSave,
+    so jobs running concurrently never write each other's ControlNet data
+    The payload is serialized by the first picture saved, every other picture and grid of the job reuses it
+    """
+    def __init__(self, datalist: list, filetype: str):
+        self.datalist = datalist
+        self.filetype = filetype
+        self._serialized: Optional[bytes] = None
+        self._lock = threading.Lock()
+
+    def serialized(self) -> bytes:
+        with self._lock:
+            if self._serialized is None:
+                self._serialized = serializeControlNetList(self.datalist)
+            else:
+                metrics.count("serialize_reused")
+            return self._serialized
 
 class ControlNetFastLoad(scripts.Script):
     def __init__(self):
@@ -86,14 +110,20 @@ class ControlNetFastLoad(scripts.Script):
             enabled, mode, uploadFile = True, args[0]['mode'], args[0]['filepath']
             saveControlnet, overwritePriority = "", args[0]['overwritePriority']
             api_package.api_instance.enabled = True
-            api_package.api_instance.drawId[id(p)] = []
+            drawStore = api_package.api_instance.drawId
+            drawStore.configure(float(opts.data.get("drawIdTTLMinutes", 60)) * 60,
+                                int(opts.data.get("drawIdCacheSizeMB", 1024)) * 1024 * 1024,
+                                opts.data.get("isEnabledDrawIdSpill", True),
+                                int(opts.data.get("maxPayloadSizeMB", 1024)) * 1024 * 1024)
+            # id(p) is reused once p is garbage collected, the store hands out IDs that never repeat
+            p.controlnetFastloadDrawId = drawStore.newId()
+            drawStore.put(p.controlnetFastloadDrawId, [])
             api_package.api_instance.info()
         else:
             enabled, mode, uploadFile = args[:3]
             saveControlnet, overwritePriority = opts.saveControlnet, opts.overwritePriority
         if enabled:
             try:
-                global controlNetList
                 break_load = False
                 controlNetModule = importlib.import_module('extensions.sd-webui-controlnet.scripts.external_code', 'external_code')
                 controlNetList = controlNetModule.get_all_units_in_processing(p)
@@ -118,18 +148,24 @@ class ControlNetFastLoad(scripts.Script):
                         controlNetList = loadFromFile(load_file_name_)
                 if len(controlNetList) > controlNetListOriLen:
                     print_warn("The ControlNet count in the file exceeds the current setting; this might cause an error.")
+                controlNetList = rebuildControlNetUnits(controlNetModule, controlNetList)
                 controlNetModule.update_cn_script_in_processing(p, controlNetList)
             if mode == "Save Only" or mode == "Load & Save":
-                global save_flag, save_filetype
-                save_flag = True
-                save_filetype = saveControlnet
-                if api_package.api_instance.enabled:
-                    api_package.api_instance.drawId[id(p)] = controlNetList
+                p.controlnetFastloadSave = SaveContext(controlNetList, saveControlnet)
+                if hasattr(p, "controlnetFastloadDrawId"):
+                    api_package.api_instance.drawId.put(p.controlnetFastloadDrawId, controlNetList,
+                                                        estimateControlNetListSize(controlNetList))
 
     def postprocess_image(self, p, pp, *args):
         print_debug("Entering postprocess_image")
         if type(args[0]) is not bool and args[0]['mode'] != "Load Only":
-            p.extra_generation_params['ControlNetID'] = id(p)
+            p.extra_generation_params['ControlNetID'] = p.controlnetFastloadDrawId
+
+    def postprocess(self, p, processed, *args):
+        print_debug("Entering postprocess")
+        # Every picture and grid of the job is saved, its payload goes as soon as the queued writes are done
+        if hasattr(p, "controlnetFastloadSave"):
+            del p.controlnetFastloadSave
 
 def uploadFileListen(pic: gr.File, enabled: bool) -> str:
     print_debug("Entering uploadFileListen")
@@ -145,26 +181,50 @@ def uploadFileListen(pic: gr.File, enabled: bool) -> str:
 
     fileInPil = Image.open(pic.name)
     gen_info, items = read_info_from_image(fileInPil)
-    print(gen_info)
+    print_debug(gen_info)
     return gen_info
 
 def judgeControlnetDataFile(filepath: str, filepathWeb: str) -> str:
     print_debug("Entering judgeControlnetDataFile")
     urlStart = re.search(r'^(.*?)/file=', filepathWeb).group(1)
-    cnList = loadFromFile(filepath, False)
     cniFilePath = filepath[:-4] + ".cni"
-    if len(cnList) > 0:
+    if hasControlNetData(filepath):
         return filepathWeb
-    elif len(cnList) == 0 and os.path.exists(cniFilePath):
-        cnList = loadFromFile(cniFilePath, False)
-        return f"{urlStart}/file={filepath[:-4]}.cni" if len(cnList) > 0 else ""
+    elif os.path.exists(cniFilePath):
+        return f"{urlStart}/file={filepath[:-4]}.cni" if hasControlNetData(cniFilePath) else ""
     else:
         return ""
 
-def viewSaveDataExecute(file: gr.File or str) -> tuple:
+def hasControlNetData(filepath: str) -> bool:
+    """
+    Header-only check whether an image or .cni file carries ControlNet data, nothing is decompressed or decoded
+    :param filepath: Image or .cni file path
+    """
+    key = fileKey(filepath)
+    if key is None:
+        return False
+    cached = headerCache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        with span("header_check"), open(filepath, 'rb') as fp:
+            located = locatePayload(fp)
+            if located is None:
+                result = False
+            else:
+                fp.seek(located[1])
+                prefix = fp.read(len(containerMagic))
+                result = isContainer(prefix) or prefix.startswith(b'\x1f\x8b')
+    except OSError:
+        result = False
+    headerCache.put(key, result)
+    return result
+
+def viewSaveDataExecute(file: gr.File or str, withImages: bool = True) -> tuple:
     """
     View saved ControlNet data from the image/.cni file
     :param file: Uploaded image/file, passed in as wrapped gr.File/str format
+    :param withImages: Whether to return the control images; without them container images are never decoded
     :return: tuple: (list, list) Refer to the UI rendering part for details; this tuple is fed to two UI components
     """
     print_debug("Entering viewSaveDataExecute")
@@ -173,18 +233,18 @@ def viewSaveDataExecute(file: gr.File or str) -> tuple:
             print_warn("You did not upload an image or file.")
             return [], {"Error": "You did not upload an image or file."}
         file_name_ = file if isinstance(file, str) else file.name
-        tmpControlNetList = loadFromFile(file_name_)
+        tmpControlNetList = loadFromFile(file_name_, decodeImages=withImages)
         previewPicture = []
         previewInformation = []
         loop_count = 0
         for itm in tmpControlNetList:
             tmp = itm if isinstance(itm, dict) else vars(itm)
             if "image" in tmp and tmp["image"] is not None:
-                if isinstance(tmp["image"], np.ndarray):
-                    image_arrays = [(tmp["image"], f"Controlnet - {loop_count}")]
-                else:
+                if withImages and isinstance(tmp["image"], np.ndarray):
+                    previewPicture.append((tmp["image"], f"Controlnet - {loop_count}"))
+                elif withImages:
                     image_arrays = [(img_array, f"Controlnet - {loop_count}") for img_array in tmp["image"].values()]
-                previewPicture.extend(image_arrays)
+                    previewPicture.extend(image_arrays)
                 tmp.pop("image")
             previewInformation.append(tmp)
             loop_count += 1
@@ -193,9 +253,27 @@ def viewSaveDataExecute(file: gr.File or str) -> tuple:
         print_err(e)
         return [], {"Error": "An unknown error occurred, see the console for details"}
 
+def getBlobStore() -> BlobStore:
+    return BlobStore(opts.data.get("blobStoreDir", "") or defaultBlobDir)
+
+def serializeControlNetList(datalist: list, local: bool = True) -> bytes:
+    """
+    Serialize ControlNetList into the container stored in images and .cni files
+    :param datalist: ControlNetList
+    :param local: Whether the result stays on this machine; only then may control images go to the blob store
+    """
+    useBlobStore = local and opts.data.get("isEnabledBlobStore", False)
+    with span("serialize"):
+        serialized_data = serializeUnits(datalist, getBlobStore() if useBlobStore else None,
+                                         opts.data.get("payloadCodec", "auto"),
+                                         int(opts.data.get("payloadCompressLevel", 1)))
+    metrics.count("serialized_bytes", len(serialized_data))
+    return serialized_data
+
 def addToPicture(image: str, datalist: list, imageType: str) -> bytes | None:
     """
-    Serialize and store ControlNetList into an image after compressing with gzip
+    Serialize and store ControlNetList into an image
+    An existing payload of the image is replaced rather than stacked
     :param image: Image path or base64-encoded string
     :param datalist: ControlNetList
     :param imageType: "filepath" / "base64"
@@ -204,39 +282,52 @@ def addToPicture(image: str, datalist: list, imageType: str) -> bytes | None:
     if imageType == "filepath" and (not os.path.exists(image)):
         print_err(f"File {image} does not exist.")
         return
-    serialized_data = gzip.compress(pickle.dumps(datalist))
-    if imageType == "filepath":
-        with open(image, 'rb') as img_file:
-            image_data = img_file.read()
-    else:
-        image_data = base64.b64decode(image)
-    combined_data = image_data + start_marker + serialized_data + end_marker
+    serialized_data = serializeControlNetList(datalist, imageType == "filepath")
     if imageType == "filepath":
-        with open(image, 'wb') as img_file:
-            img_file.write(combined_data)
+        with span("embed"):
+            embedPayload(image, serialized_data)
     else:
-        return base64.b64encode(combined_data)
+        return base64.b64encode(embedPayloadInBytes(base64.b64decode(image), serialized_data))
 
-def loadFromFile(filepath: str, enableWarn: Optional[bool] = None) -> list:
+def loadFromFile(filepath: str, enableWarn: Optional[bool] = None, decodeImages: bool = True) -> list:
     """
     Load ControlNetList from an image file
     :param filepath: Image file path
     :param enableWarn: Whether to enable warning messages
+    :param decodeImages: Decode the control images of container payloads, otherwise they stay LazyImage objects
     """
     print_debug("Entering loadFromFile")
     if not os.path.exists(filepath):
         if enableWarn is None:
             print_err(f"File {filepath} does not exist.")
         return [{"Error": f"File {filepath} does not exist."}]
-    with open(filepath, 'rb') as fp:
-        readyLoadData = fp.read()
-    start_idx = readyLoadData.find(start_marker) + len(start_marker)
-    end_idx = readyLoadData.find(end_marker)
+    maxSize = int(opts.data.get("maxPayloadSizeMB", 1024)) * 1024 * 1024
+    loadCache.resize(int(opts.data.get("loadCacheSizeMB", 512)) * 1024 * 1024)
+    cacheKey = (fileKey(filepath), decodeImages)
+    cached = loadCache.get(cacheKey) if cacheKey[0] is not None else None
+    if cached is not None:
+        return copyControlNetList(cached)
     try:
-        embedded_data = gzip.decompress(readyLoadData[start_idx:end_idx])
-        readyLoadList = pickle.loads(embedded_data)
-        return readyLoadList
-    except gzip.BadGzipFile:
+        with span("load"), open(filepath, 'rb') as fp:
+            located = locatePayload(fp)
+            if located is None:
+                raise PayloadError("No payload markers found.")
+            _, offset, length = located
+            container = openContainer(filepath, offset, length, maxSize, getBlobStore())
+            if container is not None:
+                readyLoadList = container.units(decodeImages)
+            else:
+                # Legacy gzip(pickle(list)) payload
+                embedded_data = decompressBody(iterBody(fp, offset, length), maxSize)
+                readyLoadList = pickle.loads(embedded_data)
+        if cacheKey[0] is not None:
+            loadCache.put(cacheKey, readyLoadList, estimateControlNetListSize(readyLoadList))
+        return copyControlNetList(readyLoadList)
+    except PayloadTooLarge as e:
+        if enableWarn is None:
+            print_err(f"{filepath}: {e}")
+        return [{"Error": f"{filepath}: {e}"}]
+    except (PayloadError, zlib.error):
         if enableWarn is None:
             print_err(f"{filepath} does not contain valid Controlnet Fastload data.")
         return [{"Error": f"{filepath} does not contain valid Controlnet Fastload data."}]
@@ -245,21 +336,103 @@ def loadFromFile(filepath: str, enableWarn: Optional[bool] = None) -> list:
             print_err(f"Error while loading Controlnet Fastload data from the image: {e}")
         return [{"Error": f"Error while loading Controlnet Fastload data from the image: {e}"}]
 
+def copyControlNetList(datalist: list) -> list:
+    """
+    Copy a cached ControlNetList down to its arrays, so callers are free to modify what they get
+    """
+    def copyValue(value):
+        if isinstance(value, np.ndarray):
+            return np.array(value)
+        if isinstance(value, dict):
+            return {key: copyValue(val) for key, val in value.items()}
+        if isinstance(value, list):
+            return [copyValue(val) for val in value]
+        return value
+    result = []
+    for itm in datalist:
+        if isinstance(itm, dict):
+            result.append(copyValue(itm))
+        else:
+            itmCopy = copy.copy(itm)
+            vars(itmCopy).update({key: copyValue(val) for key, val in vars(itm).items()})
+            result.append(itmCopy)
+    return result
+
+def rebuildControlNetUnits(controlNetModule, datalist: list) -> list:
+    """
+    Container payloads load every unit as a dict in which enums are their values and tuples lists,
+    rebuild them as ControlNetUnit objects of external_code the way pickled payloads loaded
+    Enum and tuple fields are restored from the type of the field on a default unit, unknown keys are dropped
+    :param controlNetModule: external_code module of the ControlNet extension
+    """
+    unitClass = getattr(controlNetModule, "ControlNetUnit", None)
+    if unitClass is None:
+        return datalist
+    defaults = vars(unitClass())
+    result = []
+    for itm in datalist:
+        if not isinstance(itm, dict) or "Error" in itm:
+            result.append(itm)
+            continue
+        fields = {}
+        for key, value in itm.items():
+            if key not in defaults:
+                continue
+            default = defaults[key]
+            if isinstance(default, Enum) and not isinstance(value, Enum):
+                try:
+                    value = type(default)(value)
+                except ValueError:
+                    value = default
+            elif isinstance(default, tuple) and isinstance(value, list):
+                value = tuple(value)
+            fields[key] = value
+        result.append(unitClass(**fields))
+    return result
+
+def estimateControlNetListSize(datalist: list) -> int:
+    def sizeOf(value) -> int:
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, dict):
+            return sum(sizeOf(val) for val in value.values())
+        if isinstance(value, list):
+            return sum(sizeOf(val) for val in value)
+        return 64
+    return sum(sizeOf(itm if isinstance(itm, dict) else vars(itm)) + 1024 for itm in datalist)
+
 def afterSavePicture(img_save_param: ImageSaveParams) -> None:
     """
     Hook function to save ControlNetList into an image after it has been saved
+    The write is queued on the background writer, generation continues while the payload is written
     :param img_save_param: Refer to script_callbacks.py
     """
     print_debug("Entering afterSavePicture")
-    if save_flag:
+    saveContext = getattr(img_save_param.p, "controlnetFastloadSave", None)
+    # API jobs save nothing here (their data is fetched by ControlNetID), neither does an unknown target
+    if saveContext is None or saveContext.filetype not in ("Embed photo", "Extra .cni file", "Both"):
+        return
+    # Both copies of this module registered the hook, the first one to see the picture writes it
+    if not getattr(img_save_param, "controlnetFastloadHandled", False):
+        img_save_param.controlnetFastloadHandled = True
         filepath = os.path.join(os.getcwd(), img_save_param.filename)
         filepath_pure, _ = os.path.splitext(filepath)
-        if save_filetype == "Embed photo" or save_filetype == "Both":
-            addToPicture(filepath, controlNetList, "filepath")
-        if save_filetype == "Extra .cni file" or save_filetype == "Both":
-            with open(filepath_pure + ".cni", 'wb'):
-                pass
-            addToPicture(filepath_pure + ".cni", controlNetList, "filepath")
-        print_info(f"ControlNet data saved to {filepath}")
+        filetype = saveContext.filetype
+
+        def write() -> None:
+            serialized_data = saveContext.serialized()
+            if filetype == "Embed photo" or filetype == "Both":
+                with span("embed"):
+                    embedPayload(filepath, serialized_data)
+            if filetype == "Extra .cni file" or filetype == "Both":
+                with span("sidecar"):
+                    writeSidecar(filepath_pure + ".cni", serialized_data)
+            print_info(f"ControlNet data saved to {filepath}")
+        if opts.data.get("isEnabledBackgroundWriter", True):
+            backgroundWriter.resize(int(opts.data.get("backgroundWriterQueueSize", 64)))
+            backgroundWriter.submit(filepath, write)
+        else:
+            write()
 
-script_callbacks.on_image_saved(afterSavePicture)
\ No newline at end of file
+script_callbacks.on_image_saved(afterSavePicture)
+script_callbacks.on_script_unloaded(lambda: backgroundWriter.flush(60))
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+from typing import Iterable, Set, Tuple
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.fastload_payload import readFooter, atomicWrite, PayloadError, defaultMaxPayloadSize
+from scripts.fastload_container import arrayFormat, encodeArray, decodeSection, openContainer
+
+extensionDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+defaultBlobDir = os.path.join(extensionDir, "blobs")
+digestPattern = re.compile(r'^[0-9a-f]{64}$')
+blobFormats = ("png", "npy")
+payloadExtensions = {".cni", ".png", ".webp", ".jpg", ".jpeg", ".jfif"}
+
+
+class BlobStore:
+    """
+    Content-addressed store of control images: every image is kept once as <root>/<hash[:2]>/<hash>.<format>,
+    payloads only hold its hash, so the same pose or depth map saved with hundreds of pictures costs one file
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str, format_: str) -> str:
+        if not digestPattern.match(digest) or format_ not in blobFormats:
+            raise PayloadError(f"Invalid blob reference {digest}.{format_}.")
+        return os.path.join(self.root, digest[:2], f"{digest}.{format_}")
+
+    def put(self, array: np.ndarray) -> Tuple[str, str]:
+        """
+        Store a control image unless an identical one is stored already
+        :return: tuple: (hash, format)
+        """
+        digest, format_ = hashArray(array), arrayFormat(array)
+        path = self.path(digest, format_)
+        if os.path.exists(path):
+            # Refresh the mtime, garbage collection spares recently used blobs
+            os.utime(path)
+            return digest, format_
+        data, _ = encodeArray(array)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomicWrite(path, lambda out: out.write(data))
+        return digest, format_
+
+    def get(self, digest: str, format_: str) -> np.ndarray:
+        path = self.path(digest, format_)
+        if not os.path.exists(path):
+            raise PayloadError(f"Blob {digest} is missing from the blob store {self.root}.")
+        with open(path, 'rb') as fp:
+            return decodeSection(fp.read(), format_)
+
+    def collectGarbage(self, roots: Iterable[str], graceSeconds: float = 3600) -> Tuple[int, int]:
+        """
+        Remove the blobs no payload under roots references any more
+        Blobs used within graceSeconds are kept, their payloads may still be on their way to disk
+        :param roots: Folders holding the pictures and .cni files that may reference blobs
+        :return: tuple: (blobs removed, bytes freed)
+        """
+        referenced = set()
+        for root in roots:
+            referenced.update(collectReferences(root, self))
+        deadline = time.time() - graceSeconds
+        removed, freed = 0, 0
+        if not os.path.isdir(self.root):
+            return removed, freed
+        for folderName, subFolders, fileNames in os.walk(self.root):
+            for fileName in fileNames:
+                digest, ext = os.path.splitext(fileName)
+                if not digestPattern.match(digest) or ext[1:] not in blobFormats or digest in referenced:
+                    continue
+                fullname = os.path.join(folderName, fileName)
+                try:
+                    st = os.stat(fullname)
+                    if st.st_mtime > deadline:
+                        continue
+                    os.remove(fullname)
+                    removed += 1
+                    freed += st.st_size
+                except OSError:
+                    continue
+        return removed, freed
+
+
+def hashArray(array: np.ndarray) -> str:
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+def collectReferences(root: str, blobStore: BlobStore) -> Set[str]:
+    """
+    Hashes of the blobs referenced by the payloads under root
+    Blob references only exist in footer-carrying containers, so files without a footer are skipped after one read
+    """
+    referenced = set()
+    for folderName, subFolders, fileNames in os.walk(root):
+        for fileName in fileNames:
+            if os.path.splitext(fileName)[1].lower() not in payloadExtensions:
+                continue
+            fullname = os.path.join(folderName, fileName)
+            try:
+                with open(fullname, 'rb') as fp:
+                    footer = readFooter(fp)
+                if footer is None:
+                    continue
+                _, offset, length = footer
+                container = openContainer(fullname, offset, length, defaultMaxPayloadSize, blobStore)
+                if container is None:
+                    continue
+                referenced.update(section["hash"] for section in container.sections if section["format"] == "blob")
+            except (OSError, ValueError, KeyError, PayloadError):
+                continue
+    return referenced
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Controlnet Fastload blob store maintenance")
+    subParsers = parser.add_subparsers(dest="command", required=True)
+    gcParser = subParsers.add_parser("gc", help="Remove blobs no longer referenced by any payload")
+    gcParser.add_argument("roots", nargs="+", help="Folders holding pictures and .cni files")
+    gcParser.add_argument("--blob-dir", default=defaultBlobDir, help="Blob store folder")
+    gcParser.add_argument("--grace", type=float, default=3600, help="Keep blobs used within this many seconds")
+    args = parser.parse_args()
+    removed, freed = BlobStore(args.blob_dir).collectGarbage(args.roots, args.grace)
+    print(f"Removed {removed} blob(s), freed {freed} bytes")
+
+
+if __name__ == "__main__":
+    main()
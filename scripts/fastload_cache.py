@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its entries, the size of an entry is given by the caller
+    onEvict(key, value) is called for every entry pushed out by the size bound
+    """
+    def __init__(self, maxSize: int, onEvict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.maxSize = maxSize
+        self.onEvict = onEvict
+        self.currentSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int = 1) -> None:
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.currentSize -= old[1]
+            if size > self.maxSize:
+                return
+            self._data[key] = (value, size)
+            self.currentSize += size
+            self._evict()
+
+    def pop(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self.currentSize -= entry[1]
+            return entry[0]
+
+    def resize(self, maxSize: int) -> None:
+        with self._lock:
+            self.maxSize = maxSize
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.currentSize = 0
+
+    def _evict(self) -> None:
+        while self.currentSize > self.maxSize and self._data:
+            key, (value, size) = self._data.popitem(last=False)
+            self.currentSize -= size
+            self.evictions += 1
+            if self.onEvict is not None:
+                self.onEvict(key, value)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "size": self.currentSize, "maxSize": self.maxSize,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def fileKey(filepath: str) -> Optional[Tuple[str, int, int]]:
+    """
+    Identity of a file's current content: (realpath, size, mtime_ns), None when the file cannot be stat'ed
+    """
+    try:
+        realpath = os.path.realpath(filepath)
+        st = os.stat(realpath)
+    except OSError:
+        return None
+    return realpath, st.st_size, st.st_mtime_ns
+
+
+# Shared by every copy of the fastload script module, webui loads it once as a script and once through imports
+loadCache = LRUCache(512 * 1024 * 1024)
+headerCache = LRUCache(4096)
@@ -0,0 +1,262 @@
+import io
+import gzip
+import json
+import lzma
+import zlib
+import struct
+import numpy as np
+from enum import Enum
+from PIL import Image
+from typing import Any, List, Optional, Tuple, Union
+from scripts.fastload_payload import PayloadError, PayloadTooLarge
+
+containerMagic = b'CNFLCONT'
+containerVersion = 2
+# Containers whose sections are all stored as plain PNG/.npy keep version 1, older releases still read them
+plainContainerVersion = 1
+headerLengthStruct = struct.Struct('<I')
+sectionKey = "$section"
+pngCompressLevel = 1
+payloadCodecs = ["auto", "stored", "png", "zlib", "gzip", "lzma"]
+sectionCodecs = ("stored", "zlib", "gzip", "lzma")
+# auto stores arrays below this size as they are, and probes this many bytes of larger ones
+autoStoredBelow = 64 * 1024
+autoProbeSize = 64 * 1024
+# auto only compresses a non-image array when the probe shrinks by at least this fraction
+autoMinSaving = 0.1
+
+
+class LazyImage:
+    """
+    A control image of a container, decoded only when load() is called
+    """
+    def __init__(self, reader: "ContainerReader", index: int):
+        section = reader.sections[index]
+        self.reader = reader
+        self.index = index
+        self.format = section["format"]
+        self.codec = section.get("codec", "stored")
+        self.shape = tuple(section["shape"])
+        self.dtype = section["dtype"]
+
+    def load(self) -> np.ndarray:
+        return self.reader.readSection(self.index)
+
+
+class ContainerReader:
+    """
+    Reader of the .cni container: magic, header length, JSON header, then the image sections
+    The JSON header holds the unit parameters, in which every control image is replaced by {"$section": index},
+    and the offset table of the sections. Opening a container only reads its header.
+    A "blob" section holds no data, only the hash of a control image kept in the blob store.
+    A section with a "codec" other than stored holds its PNG/.npy bytes compressed with that codec.
+    """
+    def __init__(self, filepath: str, offset: int, length: int, maxSize: int, blobStore: Any = None):
+        with open(filepath, 'rb') as fp:
+            fp.seek(offset)
+            head = fp.read(len(containerMagic) + headerLengthStruct.size)
+            if len(head) < len(containerMagic) + headerLengthStruct.size or not head.startswith(containerMagic):
+                raise PayloadError("The payload is not a Controlnet Fastload container.")
+            headerLength = headerLengthStruct.unpack(head[len(containerMagic):])[0]
+            if headerLength > min(length - len(head), maxSize):
+                raise PayloadError("The container header is larger than the payload.")
+            header = json.loads(fp.read(headerLength).decode('utf-8'))
+        if header.get("version", 0) > containerVersion:
+            raise PayloadError(f"Unsupported container version {header.get('version')}.")
+        self.filepath = filepath
+        self.maxSize = maxSize
+        self.blobStore = blobStore
+        self.dataOffset = offset + len(head) + headerLength
+        self.dataLength = length - len(head) - headerLength
+        self.unitList = header["units"]
+        self.sections = header["sections"]
+        for section in self.sections:
+            if section["offset"] + section["length"] > self.dataLength:
+                raise PayloadError("A container section lies outside of the payload.")
+
+    def readSection(self, index: int) -> np.ndarray:
+        """
+        Decode one image section
+        :param index: Section index
+        """
+        section = self.sections[index]
+        if section["format"] == "blob":
+            return self.readBlob(section)
+        codec = section.get("codec", "stored")
+        with open(self.filepath, 'rb') as fp:
+            fp.seek(self.dataOffset + section["offset"])
+            data = bytearray(section["length"])
+            if fp.readinto(data) != section["length"]:
+                raise PayloadError("A container section is truncated.")
+        return decodeSection(decompressSection(data, codec, self.maxSize), section["format"])
+
+    def readBlob(self, section: dict) -> np.ndarray:
+        if self.blobStore is None:
+            raise PayloadError("The payload references the blob store, but no blob store is configured.")
+        return self.blobStore.get(section["hash"], section["blobFormat"])
+
+    def units(self, decodeImages: bool = True) -> List[dict]:
+        """
+        :param decodeImages: Decode the control images, otherwise they are left as LazyImage
+        """
+        def resolve(value: Any) -> Any:
+            if isinstance(value, dict):
+                if sectionKey in value:
+                    return self.readSection(value[sectionKey]) if decodeImages else LazyImage(self, value[sectionKey])
+                return {key: resolve(val) for key, val in value.items()}
+            if isinstance(value, list):
+                return [resolve(val) for val in value]
+            return value
+        return [resolve(unit) for unit in self.unitList]
+
+
+def arrayFormat(array: np.ndarray) -> str:
+    """
+    8-bit grayscale/RGB/RGBA control images are stored as PNG, any other array as .npy
+    """
+    if array.dtype == np.uint8 and (array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (3, 4))):
+        return "png"
+    return "npy"
+
+
+def encodeArray(array: np.ndarray, format_: Optional[str] = None, level: int = pngCompressLevel) -> Tuple[bytes, str]:
+    """
+    :param format_: "png" or "npy", by default the one arrayFormat picks
+    :param level: PNG compression level
+    """
+    io_ = io.BytesIO()
+    format_ = format_ or arrayFormat(array)
+    if format_ == "png":
+        Image.fromarray(array).save(io_, format="PNG", compress_level=level)
+    else:
+        np.lib.format.write_array(io_, np.asarray(array), allow_pickle=False)
+    return io_.getvalue(), format_
+
+
+def chooseCodec(array: np.ndarray, codec: str) -> Tuple[str, str]:
+    """
+    Pick how a control image is written for the payload codec setting
+    stored writes every array as plain .npy, png writes 8-bit images as PNG and the rest as plain .npy,
+    zlib/gzip/lzma compress the .npy bytes. auto keeps small arrays plain, writes larger 8-bit images as PNG
+    and compresses other large arrays with zlib only when a probe of their first bytes shows it pays off.
+    :return: tuple: (section format, section codec)
+    """
+    if codec == "stored":
+        return "npy", "stored"
+    if codec == "png":
+        return arrayFormat(array), "stored"
+    if codec in sectionCodecs:
+        return "npy", codec
+    if array.nbytes < autoStoredBelow:
+        return "npy", "stored"
+    if arrayFormat(array) == "png":
+        return "png", "stored"
+    probe = np.ascontiguousarray(array).reshape(-1).view(np.uint8)[:autoProbeSize]
+    if len(zlib.compress(probe, 1)) > len(probe) * (1 - autoMinSaving):
+        return "npy", "stored"
+    return "npy", "zlib"
+
+
+def compressSection(data: bytes, codec: str, level: int) -> bytes:
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "gzip":
+        return gzip.compress(data, level, mtime=0)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def decompressSection(data: Union[bytes, bytearray], codec: str, maxSize: int) -> Union[bytes, bytearray]:
+    """
+    Undo compressSection, refusing to produce more than maxSize bytes
+    """
+    if codec == "stored":
+        return data
+    if codec in ("zlib", "gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if codec == "gzip" else zlib.MAX_WBITS)
+    elif codec == "lzma":
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise PayloadError(f"Unsupported section codec {codec}.")
+    try:
+        result = decompressor.decompress(data, maxSize + 1)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise PayloadError(f"A container section is corrupt: {e}")
+    if len(result) > maxSize:
+        raise PayloadTooLarge(f"The payload exceeds the maximum decompressed size of {maxSize} bytes.")
+    if not decompressor.eof:
+        raise PayloadError("A container section is truncated.")
+    return result
+
+
+def decodeSection(data: Union[bytes, bytearray], format_: str) -> np.ndarray:
+    if format_ == "png":
+        with Image.open(io.BytesIO(data)) as img:
+            return np.array(img)
+    if format_ == "npy":
+        return np.lib.format.read_array(io.BytesIO(data), allow_pickle=False)
+    raise PayloadError(f"Unsupported section format {format_}.")
+
+
+def serializeUnits(datalist: list, blobStore: Any = None, codec: str = "auto", level: int = pngCompressLevel) -> bytes:
+    """
+    Serialize ControlNetList into a container
+    :param datalist: ControlNetList, ControlNetUnit objects or dicts
+    :param blobStore: When given, control images are put into this blob store and only referenced by hash
+    :param codec: One of payloadCodecs, see chooseCodec
+    :param level: Compression level 0-9 of the PNG, zlib, gzip and lzma codecs
+    """
+    sections, blobs = [], []
+    dataLength = 0
+
+    def encode(value: Any) -> Any:
+        nonlocal dataLength
+        if isinstance(value, np.ndarray) and blobStore is not None:
+            digest, format_ = blobStore.put(value)
+            sections.append({"offset": dataLength, "length": 0, "format": "blob", "hash": digest,
+                             "blobFormat": format_, "shape": list(value.shape), "dtype": value.dtype.str})
+            return {sectionKey: len(sections) - 1}
+        if isinstance(value, np.ndarray):
+            format_, sectionCodec = chooseCodec(value, codec)
+            data = compressSection(encodeArray(value, format_, level)[0], sectionCodec, level)
+            section = {"offset": dataLength, "length": len(data), "format": format_,
+                       "shape": list(value.shape), "dtype": value.dtype.str}
+            if sectionCodec != "stored":
+                section["codec"] = sectionCodec
+            sections.append(section)
+            blobs.append(data)
+            dataLength += len(data)
+            return {sectionKey: len(sections) - 1}
+        if isinstance(value, Enum):
+            return encode(value.value)
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return {str(key): encode(val) for key, val in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(val) for val in value]
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        return str(value)
+
+    units = [encode(unit if isinstance(unit, dict) else vars(unit)) for unit in datalist]
+    version = containerVersion if any("codec" in section for section in sections) else plainContainerVersion
+    header = json.dumps({"version": version, "units": units, "sections": sections}).encode('utf-8')
+    return containerMagic + headerLengthStruct.pack(len(header)) + header + b''.join(blobs)
+
+
+def isContainer(prefix: bytes) -> bool:
+    return prefix.startswith(containerMagic)
+
+
+def openContainer(filepath: str, offset: int, length: int, maxSize: int,
+                  blobStore: Any = None) -> Optional[ContainerReader]:
+    """
+    :return: A reader when the payload at offset is a container, None for legacy gzip-pickled payloads
+    """
+    with open(filepath, 'rb') as fp:
+        fp.seek(offset)
+        if not isContainer(fp.read(len(containerMagic))):
+            return None
+    return ContainerReader(filepath, offset, length, maxSize, blobStore)
@@ -0,0 +1,252 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+indexFileName = ".controlnet_fastload_index.db"
+indexSchemaVersion = "3"
+indexWriteBatch = 500
+extensionDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class FilterIndex:
+    """
+    Persistent index of the pictures under one folder for the Controlnet Fastload Filter tab.
+    Each row is keyed by the path relative to the root and remembers the size and mtime seen at parse time,
+    so a rescan only parses new or changed files and drops the rows of deleted ones.
+    A private database runs in WAL mode, so readers never wait for a writer. A database shared through the
+    viewed folder uses a rollback journal instead: WAL needs shared memory, which network filesystems lack.
+    """
+    def __init__(self, root: str, dbPath: str, shared: bool = False):
+        self.root = root
+        self.dbPath = dbPath
+        self.shared = shared
+        self._local = threading.local()
+        self._refreshLock = threading.Lock()
+        self.lastScan = (0, 0, 0)
+        self._initSchema()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbPath, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=DELETE" if self.shared else "PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _initSchema(self) -> None:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            if row is None or row[0] != indexSchemaVersion:
+                # Rows written by another schema are parsed differently, start over
+                conn.execute("DROP TABLE IF EXISTS files")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (indexSchemaVersion,))
+            conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                         "is_image INTEGER NOT NULL, pairs TEXT NOT NULL)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _write(self, upserts: list, removed: list) -> None:
+        if not upserts and not removed:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, is_image, pairs) "
+                             "VALUES (?, ?, ?, ?, ?)", upserts)
+            conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def refresh(self, parse: Callable[[str], Optional[list]], workers: int = 1) -> Tuple[int, int, int]:
+        """
+        Bring the index in line with the folder
+        :param parse: Called with the full path of every new or changed file, returns the ControlNet pair lists
+                      of the picture ([] when it has none) or None when the file is not a picture
+        :param workers: Number of threads parsing files concurrently
+        :return: tuple: (files seen, files parsed, rows removed)
+        """
+        for _ in self.scan(parse, workers):
+            pass
+        return self.lastScan
+
+    def scan(self, parse: Callable[[str], Optional[list]], workers: int = 1,
+             batchSize: int = indexWriteBatch) -> Iterator[List[Tuple[str, list, int]]]:
+        """
+        Same as refresh, but yields the pictures of the folder in walk order as batches of
+        (full path, ControlNet pair lists, mtime_ns) while the walk is still running.
+        New or changed files are parsed on a bounded thread pool, I/O latency rather than CPU dominates
+        the scan on network drives, so threads are enough to keep several reads in flight.
+        """
+        with self._refreshLock:
+            conn = self._connect()
+            known = {path: (size, mtime, isImage, pairs) for path, size, mtime, isImage, pairs in
+                     conn.execute("SELECT path, size, mtime_ns, is_image, pairs FROM files")}
+            workers = max(1, int(workers))
+            seen, upserts, batch, pending, parsed = set(), [], [], deque(), 0
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cnfl-scan") as pool:
+                for relpath, fullname, st in walkFolder(self.root):
+                    seen.add(relpath)
+                    row = known.get(relpath)
+                    if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+                        pending.append((relpath, fullname, st, None, row))
+                    else:
+                        pending.append((relpath, fullname, st, pool.submit(parse, fullname), None))
+                    # Keep results in walk order, block only when too many parses are in flight
+                    while pending and (pending[0][3] is None or pending[0][3].done() or len(pending) > workers * 4):
+                        relpath_, fullname_, st_, future, row_ = pending.popleft()
+                        if future is None:
+                            if row_[2]:
+                                batch.append((fullname_, json.loads(row_[3]), st_.st_mtime_ns))
+                            continue
+                        pairList = future.result()
+                        parsed += 1
+                        upserts.append((relpath_, st_.st_size, st_.st_mtime_ns,
+                                        int(pairList is not None), json.dumps(pairList or [])))
+                        if pairList is not None:
+                            batch.append((fullname_, pairList, st_.st_mtime_ns))
+                    if len(upserts) >= indexWriteBatch:
+                        self._write(upserts, [])
+                        upserts = []
+                    if len(batch) >= batchSize:
+                        yield batch
+                        batch = []
+                for relpath_, fullname_, st_, future, row_ in pending:
+                    if future is None:
+                        pairList = json.loads(row_[3]) if row_[2] else None
+                    else:
+                        pairList = future.result()
+                        parsed += 1
+                        upserts.append((relpath_, st_.st_size, st_.st_mtime_ns,
+                                        int(pairList is not None), json.dumps(pairList or [])))
+                    if pairList is not None:
+                        batch.append((fullname_, pairList, st_.st_mtime_ns))
+            removed = [path for path in known if path not in seen]
+            self._write(upserts, removed)
+            self.lastScan = (len(seen), parsed, len(removed))
+            yield batch
+
+    def relpath(self, fullname: str) -> Optional[str]:
+        """
+        :return: Path of fullname relative to the root, None when it lies outside of the root
+        """
+        try:
+            relpath = os.path.relpath(os.path.realpath(fullname), os.path.realpath(self.root))
+        except ValueError:
+            return None
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep) or os.path.isabs(relpath):
+            return None
+        return relpath
+
+    def update(self, fullname: str, parse: Callable[[str], Optional[list]]) -> Optional[Tuple[str, list, int]]:
+        """
+        Index one new or rewritten file without walking the folder
+        :return: tuple: (full path, ControlNet pair lists, mtime_ns) when the file is a picture under the root
+        """
+        relpath = self.relpath(fullname)
+        if relpath is None or os.path.basename(relpath).startswith(indexFileName):
+            return None
+        try:
+            st = os.stat(fullname)
+        except OSError:
+            return None
+        pairList = parse(fullname)
+        self._write([(relpath, st.st_size, st.st_mtime_ns, int(pairList is not None), json.dumps(pairList or []))], [])
+        return None if pairList is None else (os.path.join(self.root, relpath), pairList, st.st_mtime_ns)
+
+    def poll(self, parse: Callable[[str], Optional[list]],
+             workers: int = 1) -> Tuple[List[Tuple[str, list, int]], List[str]]:
+        """
+        Walk the folder and index only what changed since the index was last written
+        :return: tuple: (new or changed pictures as (full path, ControlNet pair lists, mtime_ns),
+                         full paths of the files that are gone or no longer pictures)
+        """
+        with self._refreshLock:
+            conn = self._connect()
+            known = {path: (size, mtime, isImage) for path, size, mtime, isImage in
+                     conn.execute("SELECT path, size, mtime_ns, is_image FROM files")}
+            seen, changed = set(), []
+            for relpath, fullname, st in walkFolder(self.root):
+                seen.add(relpath)
+                row = known.get(relpath)
+                if row is None or row[:2] != (st.st_size, st.st_mtime_ns):
+                    changed.append((relpath, fullname, st))
+            with ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="cnfl-poll") as pool:
+                pairLists = list(pool.map(lambda item: parse(item[1]), changed))
+            upserts, pictures, gone = [], [], []
+            for (relpath, fullname, st), pairList in zip(changed, pairLists):
+                upserts.append((relpath, st.st_size, st.st_mtime_ns,
+                                int(pairList is not None), json.dumps(pairList or [])))
+                if pairList is not None:
+                    pictures.append((fullname, pairList, st.st_mtime_ns))
+                elif known.get(relpath, (0, 0, 0))[2]:
+                    gone.append(fullname)
+            removed = [path for path in known if path not in seen]
+            self._write(upserts, removed)
+            gone.extend(os.path.join(self.root, path) for path in removed if known[path][2])
+            return pictures, gone
+
+
+def walkFolder(root: str) -> Iterator[Tuple[str, str, os.stat_result]]:
+    """
+    Depth-first os.scandir walk yielding (relative path, full path, stat) for every file, skipping index files;
+    like os.walk it does not descend into symlinked folders
+    """
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subFolders = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subFolders.append(entry.path)
+                elif entry.is_file() and not entry.name.startswith(indexFileName):
+                    yield os.path.relpath(entry.path, root), entry.path, entry.stat()
+            except OSError:
+                continue
+        stack.extend(reversed(subFolders))
+
+
+_indexes: Dict[str, FilterIndex] = {}
+_indexesLock = threading.Lock()
+
+
+def locateIndexFile(root: str, inViewFolder: bool) -> Tuple[str, bool]:
+    """
+    Keep the index in the cache folder of the extension, or when sharing is enabled inside the viewed folder
+    so that every webui instance viewing it uses the same file; a read-only viewed folder falls back to the cache
+    :return: tuple: (database path, whether it lies in the viewed folder)
+    """
+    if inViewFolder and os.access(root, os.W_OK):
+        return os.path.join(root, indexFileName), True
+    cacheDir = os.path.join(extensionDir, "cache", "index")
+    os.makedirs(cacheDir, exist_ok=True)
+    return os.path.join(cacheDir, hashlib.sha1(root.encode("utf-8")).hexdigest()[:16] + ".db"), False
+
+
+def getIndex(root: str, inViewFolder: bool = False) -> FilterIndex:
+    with _indexesLock:
+        dbPath, shared = locateIndexFile(os.path.realpath(root), inViewFolder)
+        index = _indexes.get(dbPath)
+        if index is None:
+            index = _indexes[dbPath] = FilterIndex(os.path.normpath(root), dbPath, shared)
+        return index
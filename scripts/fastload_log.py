@@ -0,0 +1,113 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+logLevels = ["DEBUG", "INFO", "WARNING", "ERROR", "OFF"]
+levelColors = {"DEBUG": "\033[94m", "INFO": "\033[92m", "WARNING": "\033[93m", "ERROR": "\033[91m"}
+# Seconds
+histogramBuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+metricPrefix = "controlnet_fastload_"
+
+
+class ColorFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        color = levelColors.get(record.levelname, "")
+        return f"{self.formatTime(record)} - ControlNetFastload - {color}{record.levelname}\033[0m - {record.getMessage()}"
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of the extension, exported as JSON or Prometheus text
+    Gauges are callables read at export time, e.g. the depth of the background writer queue
+    """
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, List[float]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            # Bucket counts, then count and sum
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(histogramBuckets) + 3)
+            histogram[bisect.bisect_left(histogramBuckets, seconds)] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: list(values) for name, values in self.histograms.items()}
+        result = {"counters": counters, "gauges": {}, "histograms": {}}
+        for name, read in list(self.gauges.items()):
+            try:
+                result["gauges"][name] = read()
+            except Exception:
+                continue
+        for name, values in histograms.items():
+            result["histograms"][name] = {
+                "count": values[-2], "sum": values[-1],
+                "buckets": {str(bound): sum(values[:index + 1]) for index, bound in enumerate(histogramBuckets)}}
+        return result
+
+    def prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {metricPrefix}{name}_total counter", f"{metricPrefix}{name}_total {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {metricPrefix}{name} gauge", f"{metricPrefix}{name} {value}"]
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {metricPrefix}{name}_seconds histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{metricPrefix}{name}_seconds_bucket{{le="{bound}"}} {count}')
+            lines += [f'{metricPrefix}{name}_seconds_bucket{{le="+Inf"}} {histogram["count"]}',
+                      f"{metricPrefix}{name}_seconds_sum {histogram['sum']}",
+                      f"{metricPrefix}{name}_seconds_count {histogram['count']}"]
+        return "\n".join(lines) + "\n"
+
+
+def setLogLevel(level: str) -> None:
+    logger.setLevel(logging.CRITICAL + 1 if level == "OFF" else getattr(logging, level, logging.INFO))
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time the block into the histogram name, failures are counted as name_errors
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        metrics.count(f"{name}_errors")
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe(name, elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{name} took {elapsed * 1000:.2f} ms")
+
+
+# Shared by every copy of the script modules, webui loads some of them twice
+logger = logging.getLogger("ControlNetFastload")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorFormatter())
+    logger.addHandler(handler)
+    logger.propagate = False
+    # Warnings and errors only until the logLevel setting says otherwise, traces and spans are DEBUG
+    setLogLevel("WARNING")
+metrics = Metrics()
@@ -0,0 +1,121 @@
+import os
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from scripts.fastload_cache import LRUCache
+from scripts.fastload_pnginfo import readParameters, pictureExtensions
+
+unitPattern = re.compile(r'ControlNet(?: (\d+))?:\s*"([^"]+)"')
+pairPattern = re.compile(r'\s*([^:,]+):\s*(\([^)]+\)|[^,]+)(?:,|$)')
+numberPattern = re.compile(r'^-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?$')
+modelHashPattern = re.compile(r'\[([0-9a-fA-F]+)\]')
+preprocessorKeys = {"preprocessor", "module"}
+modelKeys = {"model"}
+
+
+class ControlNetUnitInfo:
+    """
+    One ControlNet unit of the generation parameters of a picture, with typed values:
+    numbers are float, parenthesized number lists tuples of float, True/False bool,
+    preprocessor names lower case and model names with collapsed whitespace and a lower case hash
+    """
+    def __init__(self, index: Optional[int], params: Dict[str, Any], facets: List[Tuple[str, str]]):
+        """
+        :param index: Unit number of "ControlNet <index>", None for the unnumbered "ControlNet" of older versions
+        :param params: Typed values by key, in the order of the parameters text
+        :param facets: (key, value) pairs of the Filter tab, see pairs
+        """
+        self.index = index
+        self.params = params
+        self.facets = facets
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        """
+        (key, value) pairs of the Filter tab, equal values are spelled the same: weight 1.0 and 1 are both "1"
+        """
+        return list(self.facets)
+
+
+@lru_cache(maxsize=65536)
+def parseField(key: str, value: str) -> Tuple[str, Any, str]:
+    """
+    Memoized, the same keys and values come back in picture after picture
+    :return: tuple: (key, typed value, value as spelled in the Filter tab)
+    """
+    key = key.strip()
+    typed = parseValue(key, value)
+    return key, typed, formatValue(typed)
+
+
+def parseValue(key: str, value: str) -> Any:
+    value = value.strip()
+    if numberPattern.match(value):
+        return float(value)
+    if value.startswith("(") and value.endswith(")"):
+        items = [itm.strip() for itm in value[1:-1].split(",")]
+        if all(numberPattern.match(itm) for itm in items):
+            return tuple(float(itm) for itm in items)
+    if value in ("True", "False"):
+        return value == "True"
+    value = " ".join(value.split())
+    if key.lower() in preprocessorKeys:
+        return value.lower()
+    if key.lower() in modelKeys:
+        return modelHashPattern.sub(lambda match: f"[{match.group(1).lower()}]", value)
+    return value
+
+
+def formatNumber(number: float) -> str:
+    return str(int(number)) if number.is_integer() and abs(number) < 1e15 else repr(number)
+
+
+def formatValue(value: Any) -> str:
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, float):
+        return formatNumber(value)
+    if isinstance(value, tuple):
+        return f"({', '.join(formatNumber(number) for number in value)})"
+    return value
+
+
+def parseControlNet(parameters: str) -> List[ControlNetUnitInfo]:
+    """
+    Parse the ControlNet units out of webui generation parameters in one pass over the text
+    """
+    units = []
+    for match in unitPattern.finditer(parameters):
+        params, facets = {}, []
+        for key, value in pairPattern.findall(match.group(2)):
+            key, typed, facet = parseField(key, value)
+            params[key] = typed
+            facets.append((key, facet))
+        units.append(ControlNetUnitInfo(int(match.group(1)) if match.group(1) else None, params, facets))
+    return units
+
+
+def readControlNetInfo(filepath: str) -> Optional[Tuple[str, List[ControlNetUnitInfo]]]:
+    """
+    Generation parameters of a picture and the ControlNet units parsed from them, memoized by file identity,
+    so the Filter scan, live updates and the diff view of the gallery parse each picture once
+    :return: tuple: (parameters text, units), None when the file is not a supported picture
+    """
+    if os.path.splitext(filepath)[1].lower() not in pictureExtensions:
+        return None
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    key = (filepath, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = parsedInfo.get(key)
+    if cached is not None:
+        return cached
+    parameters = readParameters(filepath)
+    if parameters is None:
+        return None
+    result = (parameters, parseControlNet(parameters) if parameters else [])
+    parsedInfo.put(key, result)
+    return result
+
+
+parsedInfo = LRUCache(20000)
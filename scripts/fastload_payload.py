@@ -0,0 +1,226 @@
+import io
+import os
+import zlib
+import shutil
+import struct
+import tempfile
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+start_marker = b'###START_OF_CONTROLNET_FASTLOAD###'
+end_marker = b'###END_OF_CONTROLNET_FASTLOAD###'
+footerMagic = b'CNFLFOOT'
+footerVersion = 1
+# version, offset of the payload body in the file, length of the payload body, magic
+footerStruct = struct.Struct('<HQQ8s')
+readChunkSize = 1 << 20
+# Default of the maxPayloadSizeMB setting, for readers that run without the webui settings
+defaultMaxPayloadSize = 1024 * 1024 * 1024
+
+
+def currentUmask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# Mode of files created through open(), mkstemp makes its temporary files 0600
+newFileMode = 0o666 & ~currentUmask()
+
+
+class PayloadError(Exception):
+    pass
+
+
+class PayloadTooLarge(PayloadError):
+    pass
+
+
+def buildPayload(body: bytes, offset: int) -> bytes:
+    """
+    Wrap a serialized body the way it is appended to a picture: the markers keep older readers working,
+    the footer records where the body starts and how long it is so that loads need one seek from the end
+    :param body: Compressed serialized ControlNetList
+    :param offset: Position in the target file where the wrapped payload will start
+    """
+    bodyOffset = offset + len(start_marker)
+    return start_marker + body + end_marker + footerStruct.pack(footerVersion, bodyOffset, len(body), footerMagic)
+
+
+def readFooter(fp: BinaryIO) -> Optional[Tuple[int, int, int]]:
+    """
+    :return: tuple: (version, body offset, body length), or None when the file has no valid footer
+    """
+    fileSize = fp.seek(0, os.SEEK_END)
+    if fileSize < footerStruct.size:
+        return None
+    fp.seek(fileSize - footerStruct.size)
+    version, offset, length, magic = footerStruct.unpack(fp.read(footerStruct.size))
+    if magic != footerMagic or offset < len(start_marker) or \
+            offset + length + len(end_marker) + footerStruct.size > fileSize:
+        return None
+    return version, offset, length
+
+
+def iterBody(fp: BinaryIO, offset: int, length: int) -> Iterator[bytes]:
+    fp.seek(offset - len(start_marker))
+    if fp.read(len(start_marker)) != start_marker:
+        raise PayloadError("The payload footer does not point at a payload.")
+    while length > 0:
+        chunk = fp.read(min(readChunkSize, length))
+        if not chunk:
+            raise PayloadError("The payload is truncated.")
+        length -= len(chunk)
+        yield chunk
+
+
+def decompressBody(chunks: Iterable[bytes], maxSize: int) -> bytes:
+    """
+    Stream gzip chunks through a decompressor, refusing to produce more than maxSize bytes
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    result = bytearray()
+    for chunk in chunks:
+        while chunk:
+            result += decompressor.decompress(chunk, maxSize - len(result) + 1)
+            if len(result) > maxSize:
+                raise PayloadTooLarge(f"The payload exceeds the maximum decompressed size of {maxSize} bytes.")
+            chunk = decompressor.unconsumed_tail
+    result += decompressor.flush()
+    if not decompressor.eof:
+        raise PayloadError("The payload is truncated.")
+    if len(result) > maxSize:
+        raise PayloadTooLarge(f"The payload exceeds the maximum decompressed size of {maxSize} bytes.")
+    return bytes(result)
+
+
+def rfindInFile(fp: BinaryIO, marker: bytes, end: int) -> int:
+    """
+    Search backwards from end for marker, reading one chunk at a time
+    """
+    pos, tail = end, b''
+    while pos > 0:
+        readStart = max(0, pos - readChunkSize)
+        fp.seek(readStart)
+        chunk = fp.read(pos - readStart) + tail
+        idx = chunk.rfind(marker)
+        if idx != -1:
+            return readStart + idx
+        tail = chunk[:len(marker) - 1]
+        pos = readStart
+    return -1
+
+
+def locatePayload(fp: BinaryIO) -> Optional[Tuple[int, int, int]]:
+    """
+    Find the newest payload of a file, through its footer or, for older files, its markers
+    :return: tuple: (start of the wrapped payload, body offset, body length), or None when there is no payload
+    """
+    footer = readFooter(fp)
+    if footer is not None:
+        _, offset, length = footer
+        return offset - len(start_marker), offset, length
+    # Older versions always ended the file with the end marker, anything else has no payload
+    end_idx = fp.seek(0, os.SEEK_END) - len(end_marker)
+    if end_idx < len(start_marker):
+        return None
+    fp.seek(end_idx)
+    if fp.read(len(end_marker)) != end_marker:
+        return None
+    start_idx = rfindInFile(fp, start_marker, end_idx)
+    if start_idx == -1:
+        return None
+    return start_idx, start_idx + len(start_marker), end_idx - start_idx - len(start_marker)
+
+
+def findPayloadStart(fp: BinaryIO) -> Optional[int]:
+    """
+    Where the payloads appended to a picture begin, including payloads stacked by older versions
+    :return: Length of the picture without any payload, or None when there is no payload
+    """
+    located = locatePayload(fp)
+    if located is None:
+        return None
+    start = located[0]
+    while start > 0:
+        fp.seek(max(0, start - max(footerStruct.size, len(end_marker))))
+        before = fp.read(start - fp.tell())
+        if len(before) >= footerStruct.size:
+            _, offset, length, magic = footerStruct.unpack(before[-footerStruct.size:])
+            if magic == footerMagic and offset + length + len(end_marker) + footerStruct.size == start:
+                start = offset - len(start_marker)
+                continue
+        if before.endswith(end_marker):
+            previous = rfindInFile(fp, start_marker, start - len(end_marker))
+            if previous != -1:
+                start = previous
+                continue
+        break
+    return start
+
+
+def atomicWrite(filepath: str, write: Callable[[BinaryIO], None]) -> None:
+    """
+    Write a file through a temporary file in the same folder and rename it over the target,
+    readers never see a half-written file
+    """
+    fd, tmpPath = tempfile.mkstemp(prefix=".cnfl-", suffix=".tmp", dir=os.path.dirname(filepath) or ".")
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write(out)
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmpPath)
+        else:
+            os.chmod(tmpPath, newFileMode)
+        os.replace(tmpPath, filepath)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+def embedPayload(filepath: str, body: bytes) -> None:
+    """
+    Attach a payload to a picture file. A picture without payload only gets the payload appended,
+    one that already carries payloads has them replaced by rewriting the picture through a temporary file
+    """
+    with open(filepath, 'rb') as fp:
+        pictureSize = findPayloadStart(fp)
+    if pictureSize is None:
+        with open(filepath, 'ab') as fp:
+            fp.write(buildPayload(body, fp.seek(0, os.SEEK_END)))
+        return
+
+    def write(out: BinaryIO) -> None:
+        with open(filepath, 'rb') as src:
+            remaining = pictureSize
+            while remaining > 0:
+                chunk = src.read(min(readChunkSize, remaining))
+                if not chunk:
+                    raise PayloadError(f"{filepath} changed while its payload was being replaced.")
+                out.write(chunk)
+                remaining -= len(chunk)
+        out.write(buildPayload(body, pictureSize))
+    atomicWrite(filepath, write)
+
+
+def embedPayloadInBytes(picture: bytes, body: bytes) -> bytes:
+    """
+    Same as embedPayload for a picture held in memory
+    """
+    return b''.join(embedPayloadChunks(picture, body))
+
+
+def embedPayloadChunks(picture: bytes, body: bytes) -> List[Union[bytes, memoryview]]:
+    """
+    Same as embedPayloadInBytes, as chunks to be sent one after another; the picture is not copied
+    """
+    pictureSize = findPayloadStart(io.BytesIO(picture))
+    view = memoryview(picture)[:len(picture) if pictureSize is None else pictureSize]
+    return [view, buildPayload(body, len(view))]
+
+
+def writeSidecar(filepath: str, body: bytes) -> None:
+    """
+    Write a .cni file in one pass
+    """
+    atomicWrite(filepath, lambda out: out.write(buildPayload(body, 0)))
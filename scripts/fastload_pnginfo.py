@@ -0,0 +1,186 @@
+import os
+import re
+import html
+import zlib
+import struct
+from typing import BinaryIO, Optional
+
+pictureExtensions = {".png", ".webp", ".jpg", ".jpeg", ".jfif"}
+pngSignature = b'\x89PNG\r\n\x1a\n'
+parametersKey = "parameters"
+xmpHeader = b'http://ns.adobe.com/xap/1.0/\x00'
+xmpUserComment = re.compile(r'<exif:UserComment>.*?<rdf:li[^>]*>(.*?)</rdf:li>', re.S)
+maxTextChunk = 16 * 1024 * 1024
+
+
+def readParameters(filepath: str) -> Optional[str]:
+    """
+    Read the webui generation parameters of a picture without touching its pixel data
+    Only the metadata chunks/segments in front of the image data are read, files are skipped by extension
+    and signature before anything else is parsed
+    :param filepath: Picture path
+    :return: The parameters text, "" for a picture without it, None when the file is not a supported picture
+    """
+    if os.path.splitext(filepath)[1].lower() not in pictureExtensions:
+        return None
+    try:
+        with open(filepath, 'rb', buffering=0) as fp:
+            head = fp.read(12)
+            if head[:8] == pngSignature:
+                fp.seek(8)
+                return readPngParameters(fp)
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return readWebpParameters(fp)
+            if head[:2] == b'\xff\xd8':
+                fp.seek(2)
+                return readJpegParameters(fp)
+            return None
+    except (OSError, ValueError, IndexError, struct.error, zlib.error):
+        return None
+
+
+def readPngParameters(fp: BinaryIO) -> str:
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return ""
+        length, chunkType = struct.unpack('>I4s', header)
+        if chunkType in (b'IDAT', b'IEND'):
+            return ""
+        if chunkType not in (b'tEXt', b'iTXt', b'zTXt') or length > maxTextChunk:
+            fp.seek(length + 4, os.SEEK_CUR)
+            continue
+        data = fp.read(length)
+        fp.seek(4, os.SEEK_CUR)
+        keyword, _, rest = data.partition(b'\x00')
+        if keyword.decode('latin-1') != parametersKey:
+            continue
+        if chunkType == b'tEXt':
+            return rest.decode('latin-1')
+        if chunkType == b'zTXt':
+            return zlib.decompress(rest[1:]).decode('latin-1')
+        if len(rest) < 2:
+            return ""
+        compressed, rest = rest[0], rest[2:]
+        _, _, rest = rest.partition(b'\x00')
+        _, _, text = rest.partition(b'\x00')
+        return (zlib.decompress(text) if compressed else text).decode('utf-8', errors='ignore')
+
+
+def readWebpParameters(fp: BinaryIO) -> str:
+    # Simple (lossy/lossless only) WebP files carry no metadata; for extended ones the VP8X flags tell
+    # whether EXIF/XMP chunks exist, those follow the image data and are reached by seeking past it
+    header = fp.read(8)
+    if len(header) < 8 or header[:4] != b'VP8X':
+        return ""
+    length = struct.unpack('<I', header[4:])[0]
+    flags = fp.read(1)
+    if not flags or not flags[0] & 0x0C:
+        return ""
+    fp.seek(length - 1 + (length & 1), os.SEEK_CUR)
+    xmpText = ""
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return xmpText
+        fourcc, length = struct.unpack('<4sI', header)
+        padded = length + (length & 1)
+        if fourcc == b'EXIF' and length <= maxTextChunk:
+            data = fp.read(length)
+            if data.startswith(b'Exif\x00\x00'):
+                data = data[6:]
+            text = readExifUserComment(data)
+            if text:
+                return text
+            fp.seek(padded - length, os.SEEK_CUR)
+        elif fourcc == b'XMP ' and length <= maxTextChunk:
+            xmpText = readXmpUserComment(fp.read(length)) or xmpText
+            fp.seek(padded - length, os.SEEK_CUR)
+        else:
+            fp.seek(padded, os.SEEK_CUR)
+
+
+def readJpegParameters(fp: BinaryIO) -> str:
+    comment, xmpText = "", ""
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] == 0xFF:
+            fp.seek(-1, os.SEEK_CUR)
+            continue
+        # Start of scan or end of image, the metadata segments are all in front of it
+        if marker[1] in (0xDA, 0xD9):
+            break
+        if 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+            continue
+        length = struct.unpack('>H', fp.read(2))[0] - 2
+        if marker[1] == 0xE1:
+            data = fp.read(length)
+            if data.startswith(b'Exif\x00\x00'):
+                text = readExifUserComment(data[6:])
+                if text:
+                    return text
+            elif data.startswith(xmpHeader):
+                xmpText = readXmpUserComment(data[len(xmpHeader):]) or xmpText
+        elif marker[1] == 0xFE and not comment:
+            comment = fp.read(length).decode('utf-8', errors='ignore')
+        else:
+            fp.seek(length, os.SEEK_CUR)
+    return xmpText or comment
+
+
+def readExifUserComment(tiff: bytes) -> str:
+    """
+    Find the UserComment tag (0x9286) of the Exif IFD in a TIFF structure, this is where webui stores
+    the parameters of JPEG and WebP pictures
+    """
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return ""
+    endian = '<' if tiff[:2] == b'II' else '>'
+    exifIfd = findIfdEntry(tiff, endian, struct.unpack(endian + 'I', tiff[4:8])[0], 0x8769)
+    if exifIfd is None:
+        return ""
+    entry = findIfdEntry(tiff, endian, struct.unpack(endian + 'I', exifIfd[8:12])[0], 0x9286)
+    if entry is None:
+        return ""
+    count = struct.unpack(endian + 'I', entry[4:8])[0]
+    if count <= 4:
+        comment = entry[8:8 + count]
+    else:
+        offset = struct.unpack(endian + 'I', entry[8:12])[0]
+        comment = tiff[offset:offset + count]
+    return decodeUserComment(comment)
+
+
+def findIfdEntry(tiff: bytes, endian: str, offset: int, tag: int) -> Optional[bytes]:
+    if offset + 2 > len(tiff):
+        return None
+    count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+        if len(entry) < 12:
+            return None
+        if struct.unpack(endian + 'H', entry[:2])[0] == tag:
+            return entry
+    return None
+
+
+def decodeUserComment(comment: bytes) -> str:
+    charset, data = comment[:8], comment[8:]
+    if charset == b'UNICODE\x00':
+        if data[:2] == b'\xff\xfe':
+            return data[2:].decode('utf-16-le', errors='ignore')
+        if data[:2] == b'\xfe\xff':
+            data = data[2:]
+        return data.decode('utf-16-be', errors='ignore')
+    if charset == b'ASCII\x00\x00\x00':
+        return data.decode('ascii', errors='ignore')
+    if charset == b'JIS\x00\x00\x00\x00\x00':
+        return data.decode('shift_jis', errors='ignore')
+    return comment.decode('utf-8', errors='ignore').strip('\x00')
+
+
+def readXmpUserComment(xmp: bytes) -> str:
+    match = xmpUserComment.search(xmp.decode('utf-8', errors='ignore'))
+    return html.unescape(match.group(1)) if match else ""
@@ -0,0 +1,201 @@
+import re
+import threading
+import numpy as np
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from scripts.fastload_params import parseField
+
+filterKeyOrder = ["preprocessor", "model", "weight", "starting/ending", "resize mode",
+                  "pixel perfect", "control mode", "preprocessor params"]
+rangePattern = re.compile(r'^(-?\d+(?:\.\d*)?)\s*\.\.\s*(-?\d+(?:\.\d*)?)$')
+comparePattern = re.compile(r'^(>=|<=|>|<|=)\s*(-?\d+(?:\.\d*)?)$')
+countSuffix = re.compile(r' \(\d+\)$')
+
+
+class FilterEngine:
+    """
+    Inverted index of the Filter tab: every picture gets an integer document ID, every (key, value) pair
+    a posting array of IDs, and queries combine boolean masks over the documents
+    Filters are strings "key - value", all filters of a query must match (AND); inside one filter
+    "NOT " negates, " | " separates alternatives (OR, the key may be left out after the first one),
+    and a value may be a numeric range "a..b" or a comparison ">=x", "<x", ... matching every value
+    whose numbers all satisfy it, e.g. "weight - 0.5..1" or "starting/ending - >=0.2"
+    Pictures can be added while the engine is queried: adding a path again retires its old document,
+    and masks computed before an add stay usable, the documents added since are simply not part of them
+    """
+    def __init__(self):
+        self.paths: List[str] = []
+        self._mtimes: List[int] = []
+        self._postings: Dict[str, Dict[str, List[int]]] = {}
+        self._postingArrays: Dict[Tuple[str, str], np.ndarray] = {}
+        self._order: Optional[np.ndarray] = None
+        self._docIds: Dict[str, int] = {}
+        self._removed: Set[int] = set()
+        self._alive: Optional[np.ndarray] = None
+        self._lock = threading.RLock()
+
+    def add(self, path: str, pairList: list, mtime: int) -> None:
+        with self._lock:
+            docId = len(self.paths)
+            if path in self._docIds:
+                self._removed.add(self._docIds[path])
+            self._docIds[path] = docId
+            self._alive = None
+            self.paths.append(path)
+            self._mtimes.append(mtime)
+            for pairs in pairList:
+                for key, value in pairs:
+                    posting = self._postings.setdefault(key, {}).setdefault(value, [])
+                    if not posting or posting[-1] != docId:
+                        posting.append(docId)
+                        self._postingArrays.pop((key, value), None)
+            self._order = None
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            docId = self._docIds.pop(path, None)
+            if docId is not None:
+                self._removed.add(docId)
+                self._alive = None
+
+    def __len__(self) -> int:
+        return len(self._docIds)
+
+    def aliveMask(self) -> np.ndarray:
+        """
+        Boolean mask of the documents that were not retired by a later add or a remove
+        """
+        with self._lock:
+            if self._alive is None or len(self._alive) != len(self.paths):
+                alive = np.ones(len(self.paths), dtype=bool)
+                alive[list(self._removed)] = False
+                self._alive = alive
+            return self._alive
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return filterKeyOrder + sorted(key for key in self._postings if key not in filterKeyOrder)
+
+    def postingArray(self, key: str, value: str) -> np.ndarray:
+        with self._lock:
+            array = self._postingArrays.get((key, value))
+            if array is None:
+                array = np.array(self._postings.get(key, {}).get(value, []), dtype=np.int64)
+                self._postingArrays[(key, value)] = array
+            return array
+
+    def valueMask(self, key: str, accept: Callable[[str], bool]) -> np.ndarray:
+        mask = np.zeros(len(self.paths), dtype=bool)
+        for value in list(self._postings.get(key, {})):
+            if accept(value):
+                mask[self.postingArray(key, value)] = True
+        return mask
+
+    def filterMask(self, filter_: str) -> np.ndarray:
+        negate = filter_.startswith("NOT ")
+        filter_ = filter_[4:] if negate else filter_
+        mask = np.zeros(len(self.paths), dtype=bool)
+        key = None
+        for alternative in filter_.split(" | "):
+            if " - " in alternative:
+                key, alternative = alternative.split(" - ", 1)
+            if key is None:
+                raise ValueError(f"Filter {filter_} has no key")
+            alternative = countSuffix.sub("", alternative.strip())
+            # Typed values are spelled one way in the index, "weight - 1.0" finds the pictures of weight 1
+            normalized = parseField(key, alternative)[2]
+            if alternative in self._postings.get(key, {}):
+                mask[self.postingArray(key, alternative)] = True
+            elif normalized in self._postings.get(key, {}):
+                mask[self.postingArray(key, normalized)] = True
+            else:
+                mask |= self.valueMask(key, numericPredicate(alternative))
+        return ~mask if negate else mask
+
+    def query(self, filterAll: List[str]) -> np.ndarray:
+        """
+        :return: Boolean mask over the document IDs of the pictures matching every filter
+        """
+        with self._lock:
+            mask = self.aliveMask().copy()
+            for filter_ in filterAll:
+                mask &= self.filterMask(filter_)
+            return mask
+
+    def order(self) -> np.ndarray:
+        """
+        Document IDs by mtime descending, ties in scan order
+        """
+        with self._lock:
+            if self._order is None:
+                mtimes = np.array(self._mtimes, dtype=np.int64)
+                self._order = np.lexsort((np.arange(len(mtimes)), -mtimes))
+            return self._order
+
+    def selected(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Ordered document IDs of mask, or of every live document when mask is None
+        """
+        with self._lock:
+            order = self.order()
+            if mask is None:
+                mask = self.aliveMask() if self._removed else None
+            if mask is None:
+                return order
+            if len(mask) < len(order):
+                order = order[order < len(mask)]
+            return order[mask[order]]
+
+    def count(self, mask: Optional[np.ndarray] = None) -> int:
+        with self._lock:
+            return len(self._docIds) if mask is None else int(np.count_nonzero(mask))
+
+    def page(self, mask: Optional[np.ndarray], start: int, size: int) -> List[str]:
+        """
+        One page of the ordered paths of mask, only the paths of the page are materialized
+        """
+        with self._lock:
+            return [self.paths[docId] for docId in self.selected(mask)[start:start + size]]
+
+    def counts(self, key: str, mask: Optional[np.ndarray] = None) -> List[Tuple[str, int]]:
+        """
+        Number of pictures per value of key, among the pictures of mask when given, most frequent first
+        """
+        with self._lock:
+            if mask is None and self._removed:
+                mask = self.aliveMask()
+            result = []
+            for value in list(self._postings.get(key, {})):
+                posting = self.postingArray(key, value)
+                if mask is not None:
+                    posting = posting[posting < len(mask)] if len(mask) < len(self.paths) else posting
+                    result.append((value, int(np.count_nonzero(mask[posting]))))
+                else:
+                    result.append((value, len(posting)))
+            return sorted(result, key=lambda itm: (-itm[1], itm[0]))
+
+
+def parseNumbers(value: str) -> Optional[Tuple[float, ...]]:
+    try:
+        return tuple(float(itm) for itm in value.strip().strip("()").split(","))
+    except ValueError:
+        return None
+
+
+def numericPredicate(expression: str) -> Callable[[str], bool]:
+    match = rangePattern.match(expression)
+    if match:
+        low, high = float(match.group(1)), float(match.group(2))
+        test = lambda number: low <= number <= high
+    else:
+        match = comparePattern.match(expression)
+        if not match:
+            return lambda value: False
+        operator, bound = match.group(1), float(match.group(2))
+        test = {">=": lambda number: number >= bound, "<=": lambda number: number <= bound,
+                ">": lambda number: number > bound, "<": lambda number: number < bound,
+                "=": lambda number: number == bound}[operator]
+
+    def accept(value: str) -> bool:
+        numbers = parseNumbers(value)
+        return numbers is not None and all(test(number) for number in numbers)
+    return accept
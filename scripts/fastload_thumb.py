@@ -0,0 +1,281 @@
+import os
+import site
+import hashlib
+import threading
+import multiprocessing
+from PIL import Image, features
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List, Optional, Set
+from scripts.fastload_cache import LRUCache, fileKey
+from scripts.fastload_log import logger
+
+extensionDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+defaultThumbDir = os.path.join(extensionDir, "cache", "thumbs")
+thumbFormat = "webp" if features.check("webp") else "jpeg"
+thumbQuality = 80
+
+
+def makeThumbnail(src: str, dst: str, size: int, format_: str) -> int:
+    """
+    Downscale a picture into dst, runs in the worker processes of ThumbnailCache
+    :return: Size of the thumbnail in bytes
+    """
+    with Image.open(src) as img:
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size), Image.BILINEAR)
+        if img.mode not in ("RGB", "RGBA") or (format_ == "jpeg" and img.mode != "RGB"):
+            img = img.convert("RGB")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmpPath = f"{dst}.{os.getpid()}.tmp"
+        try:
+            img.save(tmpPath, format=format_.upper(), quality=thumbQuality)
+            os.replace(tmpPath, dst)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+    return os.path.getsize(dst)
+
+
+class ThumbnailCache:
+    """
+    Downscaled copies of the pictures shown in the Filter gallery, kept as <root>/<hash[:2]>/<hash>.<format>
+    The hash covers path, size and mtime of the original, so an edited picture gets a new thumbnail.
+    Thumbnails are made by a process pool, the folder is bounded by maxBytes and evicts the least recently used.
+    Jobs wait in two queues and only a few per worker are handed to the pool at a time: the pages shown
+    in the gallery go ahead of the pictures of a folder scan, which are only queued while they fit into maxBytes.
+    When the worker processes cannot run makeThumbnail, thumbnails are made by threads instead.
+    """
+    def __init__(self, root: str, maxBytes: int, size: int = 256, workers: Optional[int] = None):
+        self.root = root
+        self.size = size
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.originals = LRUCache(200000)
+        self._usage = LRUCache(maxBytes, onEvict=lambda path, _: self._remove(path))
+        self._pending: Dict[str, Future] = {}
+        # (src, dst, future, bytes reserved from the budget by prefill)
+        self._urgent = deque()
+        self._background = deque()
+        self._waiting: Set[str] = set()
+        self._running = 0
+        self._reserved = 0
+        self._pool: Optional[Executor] = None
+        self._useThreads = False
+        self._closed = False
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def thumbPath(self, src: str) -> Optional[str]:
+        key = fileKey(src)
+        if key is None:
+            return None
+        digest = hashlib.sha1(f"{key}|{self.size}".encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}.{thumbFormat}")
+
+    def get(self, src: str) -> Optional[str]:
+        """
+        :return: The thumbnail of src, or None when it has not been made yet
+        """
+        self._loadUsage()
+        path = self.thumbPath(src)
+        if path is None or not os.path.exists(path):
+            return None
+        self.originals.put(path, src)
+        try:
+            # The mtime keeps the usage order across sessions
+            os.utime(path)
+        except OSError:
+            return None
+        if self._usage.get(path) is None:
+            self._usage.put(path, True, os.path.getsize(path))
+        return path
+
+    def submit(self, paths: Iterable[str], front: bool = False) -> List[Future]:
+        """
+        Queue the missing thumbnails of a gallery page ahead of the ones queued by prefill, without waiting for them
+        :param front: Also ahead of the pages queued before, for the page being shown
+        """
+        self._loadUsage()
+        futures, jobs = [], []
+        with self._lock:
+            for src in paths:
+                dst = self.thumbPath(src)
+                if dst is None or os.path.exists(dst):
+                    continue
+                future = self._pending.get(dst)
+                if future is not None and dst not in self._waiting:
+                    # Being made already
+                    futures.append(future)
+                    continue
+                if future is None:
+                    future = self._pending[dst] = Future()
+                # A job queued by prefill is queued again here, whichever copy is dispatched first makes it
+                jobs.append((src, dst, future, 0))
+                self._waiting.add(dst)
+                futures.append(future)
+            if front:
+                self._urgent.extendleft(reversed(jobs))
+            else:
+                self._urgent.extend(jobs)
+            self._dispatch()
+        return futures
+
+    def prefill(self, paths: Iterable[str]) -> int:
+        """
+        Queue the missing thumbnails of scanned pictures behind the gallery pages, as long as they fit into
+        maxBytes next to the thumbnails made already, so a large folder does not evict its own thumbnails
+        :return: Number of thumbnails queued
+        """
+        self._loadUsage()
+        queued = 0
+        with self._lock:
+            estimate = self._estimateSize()
+            for src in paths:
+                if self._usage.currentSize + self._reserved + estimate > self._usage.maxSize:
+                    break
+                dst = self.thumbPath(src)
+                if dst is None or dst in self._pending or os.path.exists(dst):
+                    continue
+                future = self._pending[dst] = Future()
+                self._background.append((src, dst, future, estimate))
+                self._waiting.add(dst)
+                self._reserved += estimate
+                queued += 1
+            self._dispatch()
+        return queued
+
+    def display(self, paths: List[str], timeout: float = 10) -> List[str]:
+        """
+        Thumbnails for one gallery page, missing ones are made first; a picture whose thumbnail
+        is not ready within timeout or cannot be made is shown as itself
+        """
+        futures = self.submit(paths, front=True)
+        if futures:
+            wait(futures, timeout)
+        return [self.get(src) or src for src in paths]
+
+    def original(self, path: str) -> str:
+        return self.originals.get(path) or path
+
+    def resize(self, maxBytes: int) -> None:
+        self._usage.resize(maxBytes)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+            for src, dst, future, reserved in list(self._urgent) + list(self._background):
+                future.cancel()
+            self._urgent.clear()
+            self._background.clear()
+            self._waiting.clear()
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _estimateSize(self) -> int:
+        """
+        Expected size of a thumbnail: the average of the cached ones, a guess until there are some
+        """
+        count = len(self._usage)
+        return self._usage.currentSize // count if count else self.size * self.size // 4
+
+    def _makePool(self) -> Executor:
+        if self._useThreads:
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cnfl-thumb")
+        # webui runs many threads, a forked worker may inherit a lock held by one of them and hang for good.
+        # Spawned workers start without the extension folder on sys.path, which webui only adds while it
+        # loads the scripts; the initializer is a stdlib function, so it unpickles anywhere
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=site.addsitedir, initargs=(extensionDir,))
+
+    def _useThreadPool(self, error: BaseException) -> None:
+        if not self._useThreads:
+            logger.warning(f"Thumbnail worker processes failed ({error}), making thumbnails in threads")
+            self._useThreads = True
+            pool, self._pool = self._pool, None
+            if pool is not None:
+                # The jobs it cancels come back through _done and are queued for the thread pool
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self) -> None:
+        """
+        Hand queued jobs to the pool, page jobs first, keeping a few per worker in flight; call with the lock held
+        """
+        while not self._closed and self._running < self.workers * 2 and (self._urgent or self._background):
+            job = self._urgent.popleft() if self._urgent else self._background.popleft()
+            src, dst, future, reserved = job
+            if dst not in self._waiting:
+                # Dispatched through its other queue already
+                self._reserved -= reserved
+                continue
+            self._waiting.discard(dst)
+            if self._pool is None:
+                self._pool = self._makePool()
+            try:
+                poolFuture = self._pool.submit(makeThumbnail, src, dst, self.size, thumbFormat)
+            except BrokenProcessPool as e:
+                self._useThreadPool(e)
+                self._pool = self._makePool()
+                poolFuture = self._pool.submit(makeThumbnail, src, dst, self.size, thumbFormat)
+            self._running += 1
+            poolFuture.add_done_callback(lambda f, job=job: self._done(job, f))
+
+    def _done(self, job: tuple, poolFuture: Future) -> None:
+        src, dst, future, reserved = job
+        error = None if poolFuture.cancelled() else poolFuture.exception()
+        with self._lock:
+            self._running -= 1
+            self._reserved -= reserved
+            if isinstance(error, (BrokenProcessPool, ImportError)) or (poolFuture.cancelled() and not self._closed):
+                # The process pool failed, or was shut down for failing: made again by the thread pool, first
+                if error is not None:
+                    self._useThreadPool(error)
+                self._urgent.appendleft((src, dst, future, 0))
+                self._waiting.add(dst)
+                self._dispatch()
+                return
+            self._pending.pop(dst, None)
+            self._dispatch()
+        if poolFuture.cancelled():
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            self.originals.put(dst, src)
+            self._usage.put(dst, True, poolFuture.result())
+            future.set_result(dst)
+
+    def _loadUsage(self) -> None:
+        """
+        Account the thumbnails left by earlier sessions, oldest first, so the size bound covers them too
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        found = []
+        if os.path.isdir(self.root):
+            for folderName, subFolders, fileNames in os.walk(self.root):
+                for fileName in fileNames:
+                    fullname = os.path.join(folderName, fileName)
+                    try:
+                        st = os.stat(fullname)
+                    except OSError:
+                        continue
+                    if fileName.endswith(".tmp"):
+                        self._remove(fullname)
+                        continue
+                    found.append((st.st_mtime, fullname, st.st_size))
+        for _, fullname, size in sorted(found):
+            self._usage.put(fullname, True, size)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
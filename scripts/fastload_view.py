@@ -1,49 +1,82 @@
 import os
 import re
-import PIL
+import math
+import time
+import threading
 import hashlib
 import gradio as gr
-from PIL import Image
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from modules.shared import opts
 import modules.scripts as scripts
 from modules import script_callbacks
-from scripts.fastload import judgeControlnetDataFile, print_info
+from scripts.fastload import judgeControlnetDataFile, print_info, print_warn, print_debug
+from scripts.fastload_log import metrics, span
+from scripts.fastload_index import getIndex, FilterIndex
+from scripts.fastload_params import readControlNetInfo
+from scripts.fastload_cache import LRUCache
+from scripts.fastload_query import FilterEngine, countSuffix
+from scripts.fastload_thumb import ThumbnailCache, defaultThumbDir
 import modules.generation_parameters_copypaste as parameters_copypaste
 
-picSHA256, allViewData = {}, {}
+allViewData = {}
+# (basename, size) -> paths of the displayed pictures, Gradio keeps the basename when it copies them to its temp folder
+displayPicByName = LRUCache(20000)
+# (device, inode, size, mtime) -> SHA256, only needed when two displayed pictures share a basename and size
+picSHA256 = LRUCache(20000)
+lastDisplayPic = []
 addEmoji = "➕"
 flyEmoji = "✈️"
 elemIdFlag = "controlnet_fastload_tab_"
 accessLevel = -1
+streamInterval = 2.0
+prefetchExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cnfl-prefetch")
+thumbCache = None
+# One thread indexes saved pictures in saving order, without holding up the generation
+liveExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cnfl-live")
+watcherThread = None
+# Views being rebuilt by a rescan, they take the place of their allViewData entry once complete
+rescanViews = []
+prewarmThread = None
+prewarmOutdirs = ["outdir_txt2img_samples", "outdir_img2img_samples"]
 
 class viewDataWrap:
-    def __init__(self, filepathList: list, picDict: dict):
-        print("PDebug: Entering     __init__")
-        self.filepathList = filepathList
-        self.picDict = picDict
+    def __init__(self, engine: FilterEngine, index: FilterIndex, scanning: bool = False):
+        """
+        :param scanning: The engine is still being filled by a scan, requests show what it holds so far
+        """
+        print_debug("Entering __init__")
+        self.engine = engine
+        self.index = index
+        self.scanning = scanning
 
 class ToolButton(gr.Button, gr.components.FormComponent):
     def __init__(self, **kwargs):
-        print("PDebug: Entering     __init__")
+        print_debug("Entering __init__")
         super().__init__(variant="tool", elem_classes=["toolButton"], **kwargs)
 
     def get_block_name(self):
-        print("PDebug: Entering     get_block_name")
+        print_debug("Entering get_block_name")
         return "button"
 
+def resolveAccessLevel() -> Tuple[int, bool]:
+    """
+    :return: tuple: (access level of the Filter tab before any token is entered, whether webui is reachable remotely)
+    """
+    from modules.shared import cmd_opts
+    isRemote = bool(cmd_opts.share or cmd_opts.ngrok or cmd_opts.listen or cmd_opts.server_name)
+    return (int(os.getenv("CONTROLNET_FASTLOAD_FILTER_ACCESS_CONTROL", -1)) if isRemote else 2), isRemote
+
 def on_ui_tabs() -> list:
-    print("PDebug: Entering on_ui_tabs")
+    print_debug("Entering on_ui_tabs")
     global accessLevel
-    from modules.shared import cmd_opts
-    isRemote = cmd_opts.share or cmd_opts.ngrok or cmd_opts.listen or cmd_opts.server_name
-    accessLevel = int(os.getenv("CONTROLNET_FASTLOAD_FILTER_ACCESS_CONTROL", -1)) if isRemote else 2
+    accessLevel, isRemote = resolveAccessLevel()
     accessToken = str(os.getenv("CONTROLNET_FASTLOAD_FILTER_ACCESS_TOKEN", "")) if accessLevel <= 1 else ""
     tabDebug = True if os.getenv("CONTROLNET_FASTLOAD_DEBUG", "") == "True" else False  # Only for self-test
     viewPathSelectList = ["txt2img", "img2img", "manually"] if accessLevel > 1 else ["txt2img", "img2img"]
     viewPathSelectList = [] if accessLevel == 0 else viewPathSelectList
-    print_info(f"PDebug: Load Controlnet Fastload Filter on isRemote={isRemote} and accessLevel={accessLevel}")
-    print_info(f"PDebug: You have enabled access token in Controlnet Fastload Filter") if accessToken != "" else None
+    print_debug(f"Load Controlnet Fastload Filter on isRemote={isRemote} and accessLevel={accessLevel}")
+    print_debug(f"You have enabled access token in Controlnet Fastload Filter") if accessToken != "" else None
     with gr.Blocks(analytics_enabled=False) as ui_component:
         with gr.Column():
             with gr.Row():
@@ -86,6 +119,7 @@ def on_ui_tabs() -> list:
                             nextPage = gr.Button("Next Page")
                         with gr.Column(min_width=100):
                             endPage = gr.Button("End Page")
+                    pageInfo = gr.Markdown()
                     lastViewPath = gr.Textbox(visible=False, interactive=False)
                     gallery = gr.Gallery(elem_id="_images_history_gallery", columns=6)
                 with gr.Column(scale=2):
@@ -96,7 +130,8 @@ def on_ui_tabs() -> list:
                                                 value="None",
                                                 elem_id=f'{elemIdFlag}view_path_select')
                         filterValueDropDown = gr.Dropdown(label="filter value", choices=[], multiselect=True)
-                        filterValueTextbox = gr.Dropdown(label="filter value", value="", visible=False)
+                        filterValueTextbox = gr.Textbox(label="filter expression", value="",
+                                                        placeholder="NOT model - x | y, weight - 0.5..1")
                         filterAddAll = ToolButton(value=addEmoji, elem_id=f'{elemIdFlag}filter_button')
                         filterManualSend = ToolButton(value=flyEmoji, elem_id=f'{elemIdFlag}filter_send')
                     with gr.Row():
@@ -140,7 +175,7 @@ def on_ui_tabs() -> list:
         fnLoadPictureInputListBase = [viewPath, viewPathSelect, lastViewPath, filterAll, filterKey, pageIndex]
         fnLoadPictureInputList = lambda obj: fnLoadPictureInputListBase + [obj]
         fnLoadPictureOutputList = [lastViewPath, gallery, filterKey, pageIndex,
-                                   diff, otherInfo, filterAll, filterValueDropDown]
+                                   diff, otherInfo, filterAll, filterValueDropDown, pageInfo]
         sendControlnetTxt2img.click(fn=None, _js="sendToAny2img",
                                     inputs=[selectPicAddress, selectPicControlnetAddress,
                                             sendControlnetPriority, sendControlnetTxt2img, tabDebugBox])
@@ -174,7 +209,7 @@ def on_ui_tabs() -> list:
                                outputs=fnLoadPictureOutputList)
         # Bind filterKey change event
         filterKey.input(fn=fnFilterKeyChange,
-                        inputs=[filterKey, filterAll],
+                        inputs=[filterKey, filterAll, lastViewPath],
                         outputs=[filterValueDropDown, filterValueTextbox, filterAll])
         # Bind "+" button event
         filterAddAll.click(fn=fnFilterAddAll,
@@ -186,16 +221,16 @@ def on_ui_tabs() -> list:
         return [(ui_component, "Controlnet Fastload Filter", "controlnet_fastload_filter")]
 
 
-def fnViewPathChange(viewPath: str, viewPathSelect: str, lastViewPath: str) -> list:
+def fnViewPathChange(viewPath: str, viewPathSelect: str, lastViewPath: str) -> Iterator[list]:
     if viewPathSelect != "manually":
-        return fnLoadPicture(viewPath, viewPathSelect, lastViewPath, [], [], 1)
+        yield from fnLoadPicture(viewPath, viewPathSelect, lastViewPath, [], [], 1)
     else:
-        return [lastViewPath, [], gr.update(choices=["None"]), 1, [], "", gr.update(value=[]), gr.update(value=[])]
+        yield [lastViewPath, [], gr.update(choices=["None"]), 1, [], "", gr.update(value=[]), gr.update(value=[]), ""]
 
 
 def fnaccessTokenSubmit(accessTokenInput: str, accessTokenRightSHA512: str) -> list:
     global accessLevel
-    print("PDebug: Inside fnaccessTokenSubmit")
+    print_debug("Entering fnaccessTokenSubmit")
     if accessTokenInput == str(os.getenv("CONTROLNET_FASTLOAD_FILTER_ACCESS_TOKEN", "")):
         accessLevel = 2
         return [gr.update(visible=False), gr.update(visible=False)]
@@ -203,15 +238,16 @@ def fnaccessTokenSubmit(accessTokenInput: str, accessTokenRightSHA512: str) -> l
         return [gr.update(visible=True), gr.update(visible=True)]
 
 def fnGallerySelect(selectData: gr.SelectData, gallery: list, filterAll: list) -> list:
-    print("PDebug: Inside fnGallerySelect")
-    selectFile = gallery[selectData.index]['name']  # It is in the temp folder, SHA256 is needed to verify
-    with open(selectFile, 'rb') as f:
-        originalFile = picSHA256[hashlib.sha256(f.read()).hexdigest()]
-    with Image.open(selectFile) as img:
-        if "parameters" in img.info:
-            infoList = extractControlNet(selectFile, img.info['parameters'], {}, "diff")
-        else:
-            infoList = []
+    print_debug("Entering fnGallerySelect")
+    selectFile = gallery[selectData.index]['name']  # It is in the temp folder, map it back to the original
+    originalFile = findOriginalFile(selectFile)
+    selectFileWeb = gallery[selectData.index]['data']
+    if getThumbCache() is not None:
+        # The gallery shows a thumbnail, send the original picture instead
+        selectFileWeb = f"{re.search(r'^(.*?)/file=', selectFileWeb).group(1)}/file={originalFile}"
+    # Parsed once by the scan already, unless the picture changed since
+    pngInfo, units = readControlNetInfo(originalFile) or ("", [])
+    infoList = [unit.pairs() for unit in units]
     result = []
     for info in range(len(infoList)):
         for item in infoList[info]:
@@ -220,14 +256,12 @@ def fnGallerySelect(selectData: gr.SelectData, gallery: list, filterAll: list) -
                 result.append((f"[ControlNet {info}] {filter_}\n", "include"))
             else:
                 result.append((f"[ControlNet {info}] {filter_}\n", None))
-    returnCNFilePath = judgeControlnetDataFile(originalFile, gallery[selectData.index]['data'])
-    print("PDebug: fnGallerySelect completed")
-    return [result, img.info['parameters'] if "parameters" in img.info else "",
-            gallery[selectData.index]['data'], returnCNFilePath]
+    returnCNFilePath = judgeControlnetDataFile(originalFile, selectFileWeb)
+    return [result, pngInfo, selectFileWeb, returnCNFilePath]
 
 
 def fnViewPathSelect(viewPathSelect: str) -> dict:
-    print("PDebug: Inside fnViewPathSelect")
+    print_debug("Entering fnViewPathSelect")
     if viewPathSelect == "txt2img":
         return gr.update(value=os.path.join(scripts.basedir(), opts.data.get("outdir_txt2img_samples")),
                          interactive=False)
@@ -238,59 +272,113 @@ def fnViewPathSelect(viewPathSelect: str) -> dict:
         return gr.update(value="", interactive=True)
 
 
-def fnFilterKeyChange(filterKey: str, filterAll: list) -> list:
-    print("PDebug: Inside fnFilterKeyChange")
-    picDict = {}
-    tmpList = [] if filterKey == "None" else [f"{filterKey} - {itm}" for itm in picDict[filterKey].keys()]
-    print("PDebug: fnFilterKeyChange completed")
-    return [gr.update(visible=True, choices=tmpList, value=[]), gr.update(visible=False), filterAll]
+def fnFilterKeyChange(filterKey: str, filterAll: list, lastViewPath: str) -> list:
+    print_debug("Entering fnFilterKeyChange")
+    tmpList = []
+    if filterKey != "None" and lastViewPath in allViewData:
+        # Match counts are taken among the pictures the current filters leave
+        engine = allViewData[lastViewPath].engine
+        try:
+            with span("filter_query"):
+                mask = engine.query(filterAll)
+        except ValueError as e:
+            raise gr.Error(str(e))
+        tmpList = [f"{filterKey} - {value} ({count})" for value, count in engine.counts(filterKey, mask)]
+    return [gr.update(visible=True, choices=tmpList, value=[]), gr.update(), filterAll]
 
 
 def fnFilterAddAll(filterKey: str, filterValueDropDown: list, filterValueTextbox: str, filterAll: list) -> list:
-    print("PDebug: Inside fnFilterAddAll")
-    unique_filterAll = set(filterAll)
-    if len(filterValueDropDown) > 0:
-        unique_filterAll.update(filterValueDropDown)
-    print("PDebug: fnFilterAddAll completed")
-    return list(unique_filterAll)
+    print_debug("Entering fnFilterAddAll")
+    unique_filterAll = list(filterAll)
+    newFilters = [countSuffix.sub("", itm) for itm in filterValueDropDown]
+    if filterValueTextbox.strip() != "":
+        newFilters.append(filterValueTextbox.strip())
+    unique_filterAll.extend(itm for itm in dict.fromkeys(newFilters) if itm not in unique_filterAll)
+    return unique_filterAll
 
 
-def fnLoadPicture(*args) -> list:
-    print("PDebug: Inside fnLoadPicture")
+def fnLoadPicture(*args) -> Iterator[list]:
+    print_debug("Entering fnLoadPicture")
     viewPath, viewPathSelect, lastViewPath, filterAll, filterKey, pageIndex = args[:6]
     global allViewData
     if accessLevel <= 0:
         raise gr.Error("You have no permission to use this function")
     if not (os.path.exists(viewPath) and os.path.isdir(viewPath)):
         raise gr.Error(f"ViewPath {viewPath} does not exist or not a folder")
-    if viewPath != lastViewPath:
-        # Fresh load
-        filepathList, picDict = loadPicture(viewPath)
-        allViewData[viewPath] = viewDataWrap(filepathList, picDict)
-        tmpFilterKey = list(picDict.keys())
-        tmpFilterKey.insert(0, "None")
-        displayPic, pageIndex_ = loadDisplayPic(*args,
-                                                filepathList_=filepathList, pageIndex_=pageIndex)
-        calculateSHA256(displayPic)
-        # No filter for the first time, display all images
-        return [viewPath, gr.update(value=displayPic), gr.update(choices=tmpFilterKey),
-                gr.update(value=pageIndex_), [], "", gr.update(value=[]), gr.update(value=[])]
+    view = allViewData.get(viewPath)
+    if viewPath != lastViewPath and view is not None and view.scanning:
+        # Already being scanned, by the prewarm at startup or another session: follow it instead of scanning twice
+        while True:
+            scanning = view.scanning
+            yield freshViewUpdate(args, view.engine, pageIndex, "indexing..." if scanning else "")
+            if not scanning:
+                break
+            time.sleep(streamInterval)
+        startWatcher()
+    elif viewPath != lastViewPath:
+        # Fresh load, pictures stream in batches so the first page renders before the scan finishes
+        if view is not None:
+            # Show the view from the last scan at once, the rescan only brings in what changed since
+            yield freshViewUpdate(args, view.engine, pageIndex, "refreshing...")
+        lastYield = None
+        index = getIndex(viewPath, opts.data.get("isFilterIndexInViewFolder", False))
+        oldView, view = view, viewDataWrap(FilterEngine(), index, scanning=True)
+        # Registered before the walk starts, so pictures saved meanwhile reach it even in folders already walked
+        if oldView is None:
+            allViewData[viewPath] = view
+        else:
+            rescanViews.append(view)
+        try:
+            for engine, finished in loadPictureBatches(viewPath, view.engine):
+                if oldView is not None and not finished:
+                    # The old view stays in place until the rescan is complete, it never shrinks on screen
+                    continue
+                if oldView is not None:
+                    allViewData[viewPath] = view
+                view.scanning = not finished
+                if not finished and lastYield is not None and time.monotonic() - lastYield < streamInterval:
+                    continue
+                lastYield = time.monotonic()
+                yield freshViewUpdate(args, engine, pageIndex, "" if finished else "scanning...")
+        finally:
+            view.scanning = False
+            if view in rescanViews:
+                rescanViews.remove(view)
+        startWatcher()
     else:
-        # Directly filter filepathList
-        filepathList, picDict = (allViewData[viewPath].filepathList, allViewData[viewPath].picDict)
-        allSet = set(filepathList)
-        for itm in filterAll:
-            key, val = itm.split(" - ")
-            smallSet = picDict[key][val]
-            allSet = allSet.intersection(smallSet)
-        displayPic, pageIndex_ = loadDisplayPic(*args, filepathList_=list(allSet), pageIndex_=pageIndex)
-        calculateSHA256(displayPic)
-        return [viewPath, gr.update(value=displayPic), filterKey,
-                gr.update(value=pageIndex_), [], "", gr.update(), gr.update()]
-
-
-def loadDisplayPic(*args, **kwargs) -> Tuple[List[str], int]:
-    print("PDebug: Inside loadDisplayPic")
+        # Query the filter engine, results keep a stable mtime-descending order between clicks
+        engine = allViewData[viewPath].engine
+        try:
+            with span("filter_query"):
+                mask = engine.query(filterAll)
+        except ValueError as e:
+            raise gr.Error(str(e))
+        displayPic, pageIndex_, pageInfo = loadDisplayPic(*args, engine_=engine, mask_=mask, pageIndex_=pageIndex)
+        registerDisplayPic(displayPic)
+        yield [viewPath, gr.update(value=displayPic), filterKey,
+               gr.update(value=pageIndex_), [], "", gr.update(), gr.update(), pageInfo]
+
+
+def freshViewUpdate(args: tuple, engine: FilterEngine, pageIndex: int, status: str) -> list:
+    """
+    Outputs of fnLoadPicture for a freshly loaded view, no filter yet so all pictures are displayed
+    :param status: Appended to the page information while the view is incomplete
+    """
+    tmpFilterKey = engine.keys()
+    tmpFilterKey.insert(0, "None")
+    displayPic, pageIndex_, pageInfo = loadDisplayPic(*args, engine_=engine, mask_=None, pageIndex_=pageIndex)
+    registerDisplayPic(displayPic)
+    return [args[0], gr.update(value=displayPic), gr.update(choices=tmpFilterKey),
+            gr.update(value=pageIndex_), [], "", gr.update(value=[]), gr.update(value=[]),
+            f"{pageInfo}, {status}" if status else pageInfo]
+
+
+def loadDisplayPic(*args, **kwargs) -> Tuple[List[str], int, str]:
+    """
+    Pick the requested page of the filtered pictures, only that page is handed to the gallery
+    :return: tuple: (paths of the page, page index, page information text)
+    """
+    print_debug("Entering loadDisplayPic")
     pageEnum = {
         "First Page": 0,
         "Prev Page": -1,
@@ -298,73 +386,257 @@ def loadDisplayPic(*args, **kwargs) -> Tuple[List[str], int]:
         "End Page": -1
     }
     argsLenLimit = 6
-    perPagePicNum = 36
-    pageIndex_, filepathList_ = kwargs["pageIndex_"], kwargs["filepathList_"]
-    displayAllPic = [filepathList_[i:i + perPagePicNum] for i in range(0, len(filepathList_), perPagePicNum)]
+    perPagePicNum = int(opts.data.get("filterPageSize", 36))
+    pageIndex_, engine_, mask_ = kwargs["pageIndex_"], kwargs["engine_"], kwargs["mask_"]
+    total = engine_.count(mask_)
+    pageNum = max(1, math.ceil(total / perPagePicNum))
     # fix pageIndex_
-    pageIndex_ = 1 if pageIndex_ is None else pageIndex_
-    pageIndex_ = pageIndex_ if 1 <= pageIndex_ <= len(displayAllPic) else 1
-    # No page turning operation
-    if len(args) <= argsLenLimit:
-        displayPic = filepathList_
+    pageIndex_ = 1 if pageIndex_ is None else int(pageIndex_)
+    pageIndex_ = pageIndex_ if 1 <= pageIndex_ <= pageNum else 1
     # Page turning, first or last page
-    elif len(args) > argsLenLimit and (args[argsLenLimit] == "First Page" or args[argsLenLimit] == "End Page"):
-        pageIndex_ = 1 if args[argsLenLimit] == "First Page" else len(displayAllPic)
-        displayPic = displayAllPic[pageIndex_ - 1]
+    if len(args) > argsLenLimit and (args[argsLenLimit] == "First Page" or args[argsLenLimit] == "End Page"):
+        pageIndex_ = 1 if args[argsLenLimit] == "First Page" else pageNum
     # Page turning, previous or next page
-    else:
+    elif len(args) > argsLenLimit:
         pageIndex_ = pageIndex_ + pageEnum[args[argsLenLimit]]
-        pageIndex_ = pageIndex_ if 1 <= pageIndex_ <= len(displayAllPic) else pageIndex_ - pageEnum[args[argsLenLimit]]
-        displayPic = displayAllPic[int(pageIndex_) - 1]
-    print("PDebug: loadDisplayPic completed")
-    return displayPic, pageIndex_
-
-
-def loadPicture(filepath: str) -> Tuple[List[str], dict]:
-    print("PDebug: Inside loadPicture")
-    filepathList_ = []
-    picDict_ = {"preprocessor": {}, "model": {}, "weight": {}, "starting/ending": {}, "resize mode": {},
-                "pixel perfect": {}, "control mode": {}, "preprocessor params": {}}
-    for folderName, subFolders, fileNames in os.walk(filepath):
-        for fileName in fileNames:
-            fullname = os.path.join(folderName, fileName)
-            # Process png_info
+        pageIndex_ = pageIndex_ if 1 <= pageIndex_ <= pageNum else pageIndex_ - pageEnum[args[argsLenLimit]]
+    displayPic = engine_.page(mask_, (pageIndex_ - 1) * perPagePicNum, perPagePicNum)
+    thumbCache_ = getThumbCache()
+    if thumbCache_ is not None:
+        displayPic = thumbCache_.display(displayPic)
+    if pageIndex_ < pageNum:
+        prefetchPic(engine_.page(mask_, pageIndex_ * perPagePicNum, perPagePicNum))
+    return displayPic, pageIndex_, f"{total} picture(s), page {pageIndex_} / {pageNum}"
+
+
+def prefetchPic(fileList: list) -> None:
+    """
+    Prepare the next page in the background: its thumbnails are made, or without thumbnails its pictures
+    are read so that Gradio copying them to its temp folder hits a warm cache
+    """
+    thumbCache_ = getThumbCache()
+    if thumbCache_ is not None:
+        thumbCache_.submit(fileList)
+        return
+
+    def prefetch() -> None:
+        for file in fileList:
             try:
-                with Image.open(fullname) as img:
-                    if "parameters" in img.info:
-                        extractControlNet(fullname, img.info['parameters'], picDict_, "init")
-                filepathList_.append(fullname)
-            except (PIL.UnidentifiedImageError, IOError, OSError, ValueError):
-                pass
-    print("PDebug: loadPicture completed")
-    return filepathList_, picDict_
-
-
-def extractControlNet(fullname: str, pngInfo: str, picDict_: dict, mode: str) -> list:
-    print(f"PDebug: Inside extractControlNet, mode={mode}")
-    res = re.findall(r'ControlNet[^"]+"([^"]+)"', pngInfo)
-    pairList = []
-    for itm in res:
-        pairs = re.findall(r'\s*([^:,]+):\s*(\([^)]+\)|[^,]+)(?:,|$)', itm)
-        if mode == "init":
-            for key, value in pairs:
-                picDict_.setdefault(key, {}).setdefault(value, set()).add(fullname)
-        elif mode == "diff":
-            pairList.append(pairs)
-        else:
-            pass
-    print(f"PDebug: extractControlNet completed, mode={mode}")
-    return pairList if mode == "diff" else None
+                with open(file, 'rb') as f:
+                    while f.read(1 << 20):
+                        pass
+            except OSError:
+                continue
+    prefetchExecutor.submit(prefetch)
+
+
+def getThumbCache() -> Optional[ThumbnailCache]:
+    """
+    :return: The thumbnail cache of the gallery, None when thumbnails are disabled
+    """
+    global thumbCache
+    if not opts.data.get("isEnabledThumbnail", True):
+        return None
+    size = int(opts.data.get("thumbnailSize", 256))
+    maxBytes = int(opts.data.get("thumbnailCacheSizeMB", 1024)) * 1024 * 1024
+    if thumbCache is None or thumbCache.size != size:
+        if thumbCache is not None:
+            thumbCache.shutdown()
+        thumbCache = ThumbnailCache(defaultThumbDir, maxBytes, size)
+    thumbCache.resize(maxBytes)
+    return thumbCache
+
+
+def loadPicture(filepath: str) -> FilterEngine:
+    print_debug("Entering loadPicture")
+    engine = FilterEngine()
+    for engine, _ in loadPictureBatches(filepath):
+        pass
+    return engine
+
+
+def loadPictureBatches(filepath: str, engine: Optional[FilterEngine] = None) -> Iterator[Tuple[FilterEngine, bool]]:
+    """
+    Scan a folder through its Filter index and add the ControlNet pairs of every picture to a filter engine
+    :param filepath: Folder to scan
+    :param engine: Engine to fill, a new one by default
+    :return: Iterator of (engine, finished), the same growing engine after every batch
+    """
+    print_debug("Entering loadPictureBatches")
+    start = time.perf_counter()
+    engine = FilterEngine() if engine is None else engine
+    index = getIndex(filepath, opts.data.get("isFilterIndexInViewFolder", False))
+    workers = int(opts.data.get("filterScanWorkers", 8))
+    thumbCache_ = getThumbCache()
+    for batch in index.scan(readPicturePairs, workers):
+        for fullname, pairList, mtime in batch:
+            engine.add(fullname, pairList, mtime)
+        if thumbCache_ is not None:
+            thumbCache_.prefill(fullname for fullname, _, _ in batch)
+        yield engine, False
+    seenNum, parsedNum, removedNum = index.lastScan
+    metrics.observe("scan", time.perf_counter() - start)
+    metrics.count("scan_files", seenNum)
+    metrics.count("scan_files_parsed", parsedNum)
+    print_info(f"Filter index of {filepath}: {seenNum} file(s), {parsedNum} parsed, {removedNum} removed")
+    yield engine, True
+
 
+def readPicturePairs(fullname: str) -> Optional[list]:
+    info = readControlNetInfo(fullname)
+    if info is None:
+        return None
+    return [unit.pairs() for unit in info[1]]
 
-def calculateSHA256(fileList: list) -> None:
-    print("PDebug: Inside calculateSHA256")
-    global picSHA256
+
+def onImageSaved(img_save_param) -> None:
+    """
+    Hook feeding every picture webui saves into the loaded views, fresh pictures show up without a rescan
+    :param img_save_param: Refer to script_callbacks.py
+    """
+    if allViewData:
+        liveExecutor.submit(indexSavedPicture, os.path.join(os.getcwd(), img_save_param.filename))
+
+
+def liveViews() -> List[viewDataWrap]:
+    """
+    Every view that has to follow changes on disk, the loaded ones and those being rebuilt by a rescan
+    """
+    return list({id(view): view for view in list(allViewData.values()) + list(rescanViews)}.values())
+
+
+def indexSavedPicture(fullname: str) -> None:
+    # Each index is updated once, every view built on it gets the entry
+    entries = {}
+    for view in liveViews():
+        if id(view.index) not in entries:
+            try:
+                entries[id(view.index)] = view.index.update(fullname, readPicturePairs)
+            except Exception as e:
+                print_warn(f"Failed to index {fullname}: {e}")
+                entries[id(view.index)] = None
+        entry = entries[id(view.index)]
+        if entry is not None:
+            view.engine.add(*entry)
+
+
+def onAppStarted(*args) -> None:
+    """
+    Start indexing the txt2img and img2img output folders in the background once webui is up,
+    so the first visit of the Filter tab shows a warm, or at least partly filled, view
+    """
+    global prewarmThread
+    if not opts.data.get("isEnabledFilterPrewarm", False) or prewarmThread is not None:
+        return
+    if resolveAccessLevel()[0] < 1:
+        print_debug("The Filter tab cannot view the output folders, they are not prewarmed")
+        return
+    folders = [os.path.join(scripts.basedir(), opts.data.get(key)) for key in prewarmOutdirs if opts.data.get(key)]
+    folders = [folder for folder in dict.fromkeys(folders) if os.path.isdir(folder)]
+    if folders:
+        prewarmThread = threading.Thread(target=prewarmViews, args=(folders,), name="cnfl-prewarm", daemon=True)
+        prewarmThread.start()
+
+
+def prewarmViews(folders: List[str]) -> None:
+    for folder in folders:
+        if folder in allViewData:
+            continue
+        print_info(f"Prewarming the Filter index of {folder}")
+        index = getIndex(folder, opts.data.get("isFilterIndexInViewFolder", False))
+        view = allViewData[folder] = viewDataWrap(FilterEngine(), index, scanning=True)
+        try:
+            for _, finished in loadPictureBatches(folder, view.engine):
+                view.scanning = not finished
+        except Exception as e:
+            print_warn(f"Failed to prewarm the Filter index of {folder}: {e}")
+        finally:
+            view.scanning = False
+    if allViewData:
+        startWatcher()
+
+
+def startWatcher() -> None:
+    global watcherThread
+    if watcherThread is None:
+        watcherThread = threading.Thread(target=watchViews, name="cnfl-watch", daemon=True)
+        watcherThread.start()
+
+
+def watchViews() -> None:
+    """
+    Poll the loaded views for pictures written by other processes, only new or changed files are parsed
+    """
+    while True:
+        interval = float(opts.data.get("filterWatchInterval", 0))
+        time.sleep(interval if interval > 0 else 5)
+        if interval <= 0:
+            continue
+        changes = {}
+        for view in liveViews():
+            if id(view.index) not in changes:
+                try:
+                    changes[id(view.index)] = view.index.poll(readPicturePairs,
+                                                              int(opts.data.get("filterScanWorkers", 8)))
+                except Exception as e:
+                    print_warn(f"Failed to poll {view.index.root}: {e}")
+                    changes[id(view.index)] = ([], [])
+            pictures, gone = changes[id(view.index)]
+            for fullname in gone:
+                view.engine.remove(fullname)
+            for entry in pictures:
+                view.engine.add(*entry)
+
+
+def registerDisplayPic(fileList: list) -> None:
+    print_debug("Entering registerDisplayPic")
+    global lastDisplayPic
     for file in fileList:
+        try:
+            key = (os.path.basename(file), os.path.getsize(file))
+        except OSError:
+            continue
+        paths = displayPicByName.get(key) or ()
+        if file not in paths:
+            displayPicByName.put(key, paths + (file,))
+    lastDisplayPic = list(fileList)
+
+
+def findOriginalFile(selectFile: str) -> str:
+    """
+    Map a picture copied into the Gradio temp folder back to the displayed original
+    Basename and size identify it in almost every case, files are only hashed to tell apart
+    pictures with the same basename and size from different subfolders
+    A displayed thumbnail resolves to the picture it was made from
+    """
+    thumbCache_ = getThumbCache()
+    resolve = thumbCache_.original if thumbCache_ is not None else lambda file: file
+    candidates = displayPicByName.get((os.path.basename(selectFile), os.path.getsize(selectFile))) or ()
+    candidates = [file for file in candidates if os.path.exists(file)]
+    if len(candidates) == 1:
+        return resolve(candidates[0])
+    digest = calculateSHA256(selectFile)
+    for file in candidates or lastDisplayPic:
+        if os.path.exists(file) and calculateSHA256(file) == digest:
+            return resolve(file)
+    raise gr.Error("The selected picture is no longer in the view, please reload the page")
+
+
+def calculateSHA256(file: str) -> str:
+    st = os.stat(file)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    digest = picSHA256.get(key)
+    if digest is None:
+        sha256 = hashlib.sha256()
         with open(file, 'rb') as f:
-            picSHA256[hashlib.sha256(f.read()).hexdigest()] = file
-    print("PDebug: calculateSHA256 completed")
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        picSHA256.put(key, digest)
+    return digest
 
 
 script_callbacks.on_ui_tabs(on_ui_tabs)
+script_callbacks.on_image_saved(onImageSaved)
+script_callbacks.on_app_started(onAppStarted)
 
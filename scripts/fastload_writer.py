@@ -0,0 +1,79 @@
+import time
+import queue
+import atexit
+import threading
+from collections import deque
+from typing import Callable, Optional
+from scripts.fastload_log import logger
+
+
+class BackgroundWriter:
+    """
+    Runs payload writes on a daemon thread behind a bounded queue, generation goes on while they are written
+    submit blocks while the queue is full, so a slow disk throttles generation instead of letting
+    queued ControlNet data pile up in memory
+    """
+    def __init__(self, maxQueue: int = 64, name: str = "cnfl-writer"):
+        self.name = name
+        self.written = 0
+        self.failed = 0
+        self.errors = deque(maxlen=20)
+        self._queue = queue.Queue(maxQueue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, target: str, job: Callable[[], None]) -> None:
+        """
+        :param target: File written by job, reported when it fails
+        :param job: Does the write, it must only use data captured when it was created
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._queue.put((target, job))
+
+    def _run(self) -> None:
+        while True:
+            target, job = self._queue.get()
+            try:
+                job()
+                with self._lock:
+                    self.written += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                    self.errors.append({"target": target, "error": str(e), "time": time.time()})
+                logger.error(f"Failed to write ControlNet data to {target}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every submitted write has finished
+        :return: False when timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def resize(self, maxQueue: int) -> None:
+        with self._queue.mutex:
+            self._queue.maxsize = max(1, maxQueue)
+            self._queue.not_full.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"depth": self._queue.qsize(), "maxDepth": self._queue.maxsize,
+                    "pending": self._queue.unfinished_tasks, "written": self.written, "failed": self.failed,
+                    "errors": list(self.errors)}
+
+
+# Shared by every copy of the fastload script module, pictures saved by any of them go through one queue
+backgroundWriter = BackgroundWriter()
+atexit.register(backgroundWriter.flush, 60)
@@ -1,11 +1,23 @@
 import gradio as gr
 from modules import shared
 from modules import script_callbacks
+from scripts.fastload_log import logLevels, setLogLevel
+from scripts.fastload_container import payloadCodecs
 
 
 def on_ui_settings():
-    print("PDebug: Entering on_ui_settings")
     section = ('controlnet-fastload', "Controlnet Fastload")
+    shared.opts.add_option(
+        "logLevel",
+        shared.OptionInfo(
+            "WARNING",
+            "Controlnet Fastload console log level (DEBUG traces every call and timing span).",
+            gr.Dropdown,
+            lambda: {"choices": logLevels},
+            onchange=lambda: setLogLevel(shared.opts.data.get("logLevel", "WARNING")),
+            section=section)
+    )
+    setLogLevel(shared.opts.data.get("logLevel", "WARNING"))
     shared.opts.add_option(
         "isEnabledManualSend",
         shared.OptionInfo(
@@ -32,6 +44,172 @@ def on_ui_settings():
             lambda: {"choices": ["ControlNet Plugin First", "ControlNet Fastload Plugin First"]},
             section=section)
     )
+    shared.opts.add_option(
+        "isEnabledBackgroundWriter",
+        shared.OptionInfo(
+            True,
+            "Write Controlnet data into saved pictures and .cni files in the background while generation continues.",
+            gr.Checkbox,
+            section=section)
+    )
+    shared.opts.add_option(
+        "backgroundWriterQueueSize",
+        shared.OptionInfo(
+            64,
+            "Number of pictures that may wait for their Controlnet data to be written before generation waits for the disk.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "drawIdTTLMinutes",
+        shared.OptionInfo(
+            60,
+            "Minutes the Controlnet data of an API generation stays available to /controlnetFastload/fetch.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "drawIdCacheSizeMB",
+        shared.OptionInfo(
+            1024,
+            "Memory budget (MB) for the Controlnet data of API generations.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "isEnabledDrawIdSpill",
+        shared.OptionInfo(
+            True,
+            "Move the Controlnet data of API generations over the memory budget to disk instead of dropping it.",
+            gr.Checkbox,
+            section=section)
+    )
+    shared.opts.add_option(
+        "apiBatchWorkers",
+        shared.OptionInfo(
+            4,
+            "Number of threads processing the items of Controlnet Fastload batch API requests.",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "isFilterIndexInViewFolder",
+        shared.OptionInfo(
+            False,
+            "Store the Controlnet Fastload Filter index inside the viewed folder, so webui instances sharing it reuse one index.",
+            gr.Checkbox,
+            section=section)
+    )
+    shared.opts.add_option(
+        "filterScanWorkers",
+        shared.OptionInfo(
+            8,
+            "Number of threads reading pictures while the Controlnet Fastload Filter scans a folder.",
+            gr.Slider,
+            {"minimum": 1, "maximum": 64, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "filterPageSize",
+        shared.OptionInfo(
+            36,
+            "Number of pictures per page in the Controlnet Fastload Filter gallery.",
+            gr.Slider,
+            {"minimum": 6, "maximum": 240, "step": 6},
+            section=section)
+    )
+    shared.opts.add_option(
+        "isEnabledFilterPrewarm",
+        shared.OptionInfo(
+            False,
+            "Index the txt2img and img2img output folders for the Controlnet Fastload Filter in the background when webui starts.",
+            gr.Checkbox,
+            section=section).needs_restart()
+    )
+    shared.opts.add_option(
+        "filterWatchInterval",
+        shared.OptionInfo(
+            0,
+            "Check the loaded Controlnet Fastload Filter folders for pictures written by other programs every this many seconds (0 to disable).",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "isEnabledThumbnail",
+        shared.OptionInfo(
+            True,
+            "Show cached thumbnails in the Controlnet Fastload Filter gallery instead of the full pictures.",
+            gr.Checkbox,
+            section=section)
+    )
+    shared.opts.add_option(
+        "thumbnailSize",
+        shared.OptionInfo(
+            256,
+            "Longest side (px) of the Controlnet Fastload Filter thumbnails.",
+            gr.Slider,
+            {"minimum": 64, "maximum": 1024, "step": 32},
+            section=section)
+    )
+    shared.opts.add_option(
+        "thumbnailCacheSizeMB",
+        shared.OptionInfo(
+            1024,
+            "Disk budget (MB) of the Controlnet Fastload Filter thumbnail cache.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "payloadCodec",
+        shared.OptionInfo(
+            "auto",
+            "How control images are compressed in saved Controlnet data (auto picks by size and content, stored is fastest, lzma is smallest).",
+            gr.Dropdown,
+            lambda: {"choices": payloadCodecs},
+            section=section)
+    )
+    shared.opts.add_option(
+        "payloadCompressLevel",
+        shared.OptionInfo(
+            1,
+            "Compression level of the png, zlib, gzip and lzma codecs (higher is smaller and slower).",
+            gr.Slider,
+            {"minimum": 0, "maximum": 9, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "maxPayloadSizeMB",
+        shared.OptionInfo(
+            1024,
+            "Maximum decompressed size (MB) of the Controlnet data loaded from an image or .cni file.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "loadCacheSizeMB",
+        shared.OptionInfo(
+            512,
+            "Memory budget (MB) for caching Controlnet data loaded from images and .cni files.",
+            gr.Number,
+            section=section)
+    )
+    shared.opts.add_option(
+        "isEnabledBlobStore",
+        shared.OptionInfo(
+            False,
+            "Store each control image once in a shared blob folder and only reference it from saved pictures and .cni files (they then only load on this machine).",
+            gr.Checkbox,
+            section=section)
+    )
+    shared.opts.add_option(
+        "blobStoreDir",
+        shared.OptionInfo(
+            "",
+            "Blob folder for control images; leave empty to use the blobs folder of this extension.",
+            gr.Textbox,
+            section=section)
+    )
 
 
 script_callbacks.on_ui_settings(on_ui_settings)